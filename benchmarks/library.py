@@ -0,0 +1,103 @@
+import base64
+import io
+import json
+import pathlib
+import random
+import shutil
+import string
+import subprocess
+import typing
+import mutagen
+import mutagen.flac
+import mutagen.id3
+import mutagen.mp4
+from PIL import Image
+
+#encoder used for each input type, so the library is the same no matter what ffmpeg defaults to
+CODECS = {
+    '.mp3': ('libmp3lame', ['-b:a', '128k']),
+    '.mp4': ('aac', ['-b:a', '128k']),
+    '.mkv': ('libvorbis', ['-q:a', '3']),
+    '.webm': ('libopus', ['-b:a', '96k']),
+    '.m4a': ('aac', ['-b:a', '128k']),
+    '.aac': ('aac', ['-b:a', '128k']),
+    '.wav': ('pcm_s16le', []),
+    '.ogg': ('libvorbis', ['-q:a', '3']),
+    '.opus': ('libopus', ['-b:a', '96k']),
+    '.flac': ('flac', []),
+}
+ID_CHARS = string.ascii_letters + string.digits + '-_'
+WORDS = ("night", "city", "blue", "echo", "paper", "signal", "river", "static", "summer", "ghost", "glass", "orbit", "velvet", "neon", "hollow", "tide")
+
+def make_cover(rng: random.Random, size: int = 600) -> bytes:
+    '''Random two-colour jpeg, big enough that it has to be rescaled'''
+    img = Image.new("RGB", (size, size), tuple(rng.randrange(256) for _ in range(3)))
+    img.paste(tuple(rng.randrange(256) for _ in range(3)), (size//4, size//4, size*3//4, size*3//4))
+    raw = io.BytesIO()
+    img.save(raw, format='JPEG', quality=85)
+    return raw.getvalue()
+
+def embed_cover(path: pathlib.Path, cover: bytes):
+    '''Embeds `cover` the way each container stores pictures, containers mutagen can't tag are left without one'''
+    muta_file = mutagen.File(path)
+    if isinstance(muta_file, mutagen.flac.FLAC):
+        picture = mutagen.flac.Picture()
+        picture.type, picture.mime, picture.data = 3, 'image/jpeg', cover
+        muta_file.add_picture(picture)
+    elif isinstance(muta_file, mutagen.mp4.MP4):
+        muta_file['covr'] = [mutagen.mp4.MP4Cover(cover, imageformat=mutagen.mp4.MP4Cover.FORMAT_JPEG)]
+    elif muta_file is not None and isinstance(muta_file.tags, mutagen.id3.ID3):
+        muta_file.tags.add(mutagen.id3.APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=cover))
+    elif muta_file is not None and path.suffix in ('.ogg', '.opus'):
+        picture = mutagen.flac.Picture()
+        picture.type, picture.mime, picture.data = 3, 'image/jpeg', cover
+        muta_file['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+    else:
+        return
+    muta_file.save()
+
+def filename(rng: random.Random, index: int, title: str, artist: str, suffix: str) -> str:
+    '''Mixes plain names with the youtube-dl and niconico naming schemes the metadata handlers look for'''
+    style = index % 4
+    if style == 0:
+        return f"{artist} - {title}-{''.join(rng.choice(ID_CHARS) for _ in range(11))}{suffix}"
+    elif style == 1:
+        return f"{title} [{''.join(rng.choice(ID_CHARS) for _ in range(11))}]{suffix}"
+    elif style == 2:
+        return f"{title} [sm{rng.randrange(10**7, 10**8)}]{suffix}"
+    return f"{index:02d} {title}{suffix}"
+
+def generate(root: pathlib.Path, files: int, formats: typing.Sequence[str], duration: float = 3, seed: int = 0, albums: int = 8) -> list[pathlib.Path]:
+    '''
+    Writes `files` sine tone songs spread over `albums` album directories, cycling through `formats`.
+    Songs are tagged and share a cover per album. The same arguments always produce the same library,
+    and an existing library generated with the same arguments is reused as is.
+    '''
+    params = {'files': files, 'formats': list(formats), 'duration': duration, 'seed': seed, 'albums': albums}
+    index_file = root / "library.json"
+    if index_file.is_file():
+        index = json.loads(index_file.read_text())
+        if index['params'] == params and all((root / p).is_file() for p in index['files']):
+            return [root / p for p in index['files']]
+        shutil.rmtree(root)
+    root.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    covers = [make_cover(rng) for _ in range(albums)]
+    created = []
+    for i in range(files):
+        suffix = formats[i % len(formats)]
+        album = i % albums
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title()
+        artist = f"Artist {album % 3}"
+        path = root / f"{artist} - Album {album}" / filename(rng, i, title, artist, suffix)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        codec, codec_args = CODECS[suffix]
+        tags = {'title': title, 'artist': artist, 'album': f"Album {album}", 'date': str(2000 + album), 'track': str(i // albums + 1)}
+        subprocess.run(["ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"sine=frequency={rng.randrange(220, 880)}:duration={duration}",
+            *(arg for key, value in tags.items() for arg in ("-metadata", f"{key}={value}")),
+            "-c:a", codec, *codec_args, str(path)], check=True)
+        embed_cover(path, covers[album])
+        created.append(path)
+    index_file.write_text(json.dumps({'params': params, 'files': [str(p.relative_to(root)) for p in created]}, indent=2))
+    return created
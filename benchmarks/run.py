@@ -0,0 +1,140 @@
+'''
+Offline benchmark: generates a synthetic library and times scanning, metadata parsing, conversion and cleanup on it.
+Only the File metadata handler is enabled, so nothing touches the network.
+The JSON report is meant to be diffed between commits, e.g.
+
+    python benchmarks/run.py --files 200 --jobs 4 -o before.json
+'''
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import pathlib
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import library
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import shrinkify
+from shrinkify import config
+from shrinkify import metrics
+from shrinkify import songclass
+from shrinkify.utils import scanner
+
+def peak_rss() -> dict[str, int]:
+    '''
+    Peak resident set size in KiB of this process and of the largest finished child (ffmpeg) so far.
+    ru_maxrss never goes down, so this is the peak of the whole run up to now, not of the last stage.
+    '''
+    scale = 1024 if sys.platform == 'darwin' else 1 #bytes on macos, KiB elsewhere
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale, 'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale}
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=pathlib.Path(__file__).parent, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Stages(object):
+    """Collects the wall time and throughput of each benchmark stage, with the peak RSS of the run at its end"""
+    def __init__(self) -> None:
+        self.results: dict[str, dict] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str, files: int):
+        logging.info(f"{name}: {files} files")
+        result = {'files': files}
+        start = time.perf_counter()
+        yield result
+        result['seconds'] = round(time.perf_counter() - start, 4)
+        result['files_per_sec'] = round(files / result['seconds'], 2) if result['seconds'] else None
+        #cumulative, only an increase over the previous stage says anything about this one
+        result['cumulative_peak_rss_kib'] = peak_rss()
+        self.results[name] = result
+
+def make_config(library_root: pathlib.Path, work: pathlib.Path, args: argparse.Namespace) -> config.Config:
+    conf = config.generate_default()
+    conf.cfgdir = work / "config"
+    conf.general.root = library_root
+    conf.general.output = work / "compressed"
+    conf.general.cache_dir = work / "cache"
+    conf.general.cache_file = work / "cache" / "cache.sqlite"
+    conf.general.manifest_file = work / "manifest.sqlite"
+    conf.general.loglevel = logging.WARNING
+    conf.metadata.identifiers = ("File",) #the other handlers all need the network
+    conf.conversion.jobs = args.jobs
+    conf.conversion.metadata_jobs = args.jobs
+    conf.utils.cleanup.delete = True
+    return conf
+
+def run(args: argparse.Namespace) -> dict:
+    stages = Stages()
+    library_root = pathlib.Path(args.library).expanduser().absolute()
+    formats = args.formats or config.General().input_types
+    with stages.stage("generate", args.files):
+        songs = library.generate(library_root, args.files, formats, args.duration, args.seed)
+    with tempfile.TemporaryDirectory(prefix="shrinkify-bench") as work_dir:
+        work = pathlib.Path(work_dir)
+        conf = make_config(library_root, work, args)
+        shrink = shrinkify.Shrinkify(conf)
+        with stages.stage("scan", len(songs)) as result:
+            result['found'] = sum(1 for _ in scanner.scan(library_root, conf.general.input_types, conf.general.exclude_filter))
+        with stages.stage("metadata", len(songs)) as result:
+            failed = 0
+            for path in songs:
+                try:
+                    shrink.metaprocessor.parse(songclass.Song(path))
+                except Exception as e:
+                    logging.debug(f"Could not parse {path}: {e}")
+                    failed += 1
+            result['failed'] = failed
+        with stages.stage("shrink", len(songs)) as result:
+            result['failed'] = len(shrink.shrink_directory(library_root))
+        with stages.stage("shrink_noop", len(songs)) as result:
+            result['failed'] = len(shrink.shrink_directory(library_root))
+        #orphan every tenth output by hiding its source
+        hidden = songs[::10]
+        for path in hidden:
+            path.rename(path.with_name(f".hidden{path.name}.bench"))
+        try:
+            with stages.stage("cleanup", len(songs)) as result, contextlib.redirect_stdout(io.StringIO()):
+                result['orphans'], _ = shrink.cleanup()
+        finally:
+            for path in hidden:
+                path.with_name(f".hidden{path.name}.bench").rename(path)
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': {'files': args.files, 'formats': list(formats), 'duration': args.duration, 'seed': args.seed, 'jobs': args.jobs},
+        'stages': stages.results,
+        'spans': metrics.recorder.summary()['stages'],
+        'peak_rss_kib': peak_rss(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark shrinkify on a synthetic library")
+    parser.add_argument("-n", "--files", default=100, type=int, help="Number of songs in the library")
+    parser.add_argument("--formats", nargs='+', help="Input types to generate, defaults to every input type")
+    parser.add_argument("--duration", default=3, type=float, help="Length of each song in seconds")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("-j", "--jobs", default=os.cpu_count() or 1, type=int)
+    parser.add_argument("--library", default=pathlib.Path(tempfile.gettempdir(), "shrinkify-bench-library"), help="Where the library is generated, reused between runs")
+    parser.add_argument("-o", "--output", default="-", help="File to write the report to, - for stdout")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    report = json.dumps(run(args), indent=2)
+    if args.output == "-":
+        print(report)
+    else:
+        pathlib.Path(args.output).write_text(report)
+
+if __name__ == "__main__":
+    main()
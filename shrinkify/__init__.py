@@ -1,20 +1,31 @@
-import base64
 import copy
+import errno
 import os
 import pathlib
 import logging
 import subprocess
-import io
 import argparse
 import sys
 import time
 import hashlib
+import uuid
+import concurrent.futures
+import collections
+import queue
+import threading
+import typing
 from types import EllipsisType
 import shutil
 from PIL import Image
 from . import metadata
 from . import config #FIXME
 from . import songclass
+from . import manifest
+from . import coverart
+from . import metrics
+from .metadata import caching
+from .utils import scanner
+from .utils import fswatch
 
 import mutagen
 import mutagen.easymp4
@@ -26,6 +37,17 @@ MUTAGEN_KEY_CONVERSION = {
     'encoder': '\xa9too'
 }
 
+def ffmetadata_escape(value: str) -> str:
+    for char in '\\=;#\n':
+        value = value.replace(char, '\\'+char)
+    return value
+
+def ffmetadata_document(tags: dict[str, str]) -> bytes:
+    """Renders tags in ffmpeg's ffmetadata format, which has no length limit unlike command line arguments"""
+    lines = [';FFMETADATA1']
+    lines.extend(f"{ffmetadata_escape(k)}={ffmetadata_escape(v)}" for k, v in tags.items())
+    return ("\n".join(lines)+"\n").encode('utf8')
+
 class Shrinkify(object):
     """
     The class used to handle the conversion of files
@@ -35,7 +57,25 @@ class Shrinkify(object):
         self.root = pathlib.Path(config.general.root)
         self.output = pathlib.Path(config.general.output)
         self.config = config
-        self.metaprocessor = metadata.MetadataParser(self.config)
+        self.manifest = manifest.ConversionManifest(self.config) if self.config.general.use_manifest else None
+        #built on first use, commands like cleanup never need the metadata cache or the api clients
+        self._metaprocessor: metadata.MetadataParser | None = None
+        self._covers: coverart.CoverArtCache | None = None
+        self._lazy_lock = threading.Lock()
+
+    @property
+    def metaprocessor(self) -> metadata.MetadataParser:
+        with self._lazy_lock:
+            if self._metaprocessor is None:
+                self._metaprocessor = metadata.MetadataParser(self.config)
+            return self._metaprocessor
+
+    @property
+    def covers(self) -> coverart.CoverArtCache:
+        with self._lazy_lock:
+            if self._covers is None:
+                self._covers = coverart.CoverArtCache(self.config)
+            return self._covers
     
     def get_output_file(self, file: os.PathLike | str) -> pathlib.Path:
         pfile = pathlib.Path(file)
@@ -48,102 +88,399 @@ class Shrinkify(object):
             logging.debug(f"Assuming file {pfile} is relative to root")
             return pathlib.Path(self.root, pfile).with_suffix(self.config.general.output_type)
     
-    def is_valid_file(self, file: pathlib.Path, exist_ok=False):
-        if set(file.parts).intersection(self.config.general.exclude_filter):
-            return False
-        if file.suffix not in self.config.general.input_types:
-            return False
-        if self.get_output_file(file).exists() and not exist_ok:
-            return False
-        return True
-
-    def cleanup(self):
-        root_list = filter(lambda x: self.is_valid_file(x, exist_ok=True), pathlib.Path(self.config.general.root).rglob("*"))
-        child_list = set(self.get_output_file(f) for f in root_list)
-        output_list = set(e for e in pathlib.Path(self.config.general.output).rglob("*") if e.is_file() and e.suffix == self.config.general.output_type)
-        diffs = output_list.difference(child_list)
-        for diff in diffs:
-            print(str(diff))
-            if self.config.utils.cleanup.delete:
-                diff.unlink()
+    def scan_library(self, directory: os.PathLike | str) -> typing.Iterator[os.DirEntry]:
+        '''Streams the DirEntry of every convertable file below `directory`, skipping excluded trees without descending into them'''
+        if set(pathlib.Path(directory).parts).intersection(self.config.general.exclude_filter):
+            return
+        for entry in scanner.scan(directory, self.config.general.input_types, self.config.general.exclude_filter):
+            if not entry.name.startswith("shrinkify_temp"): #in-progress conversion
+                yield entry
+
+    def find_orphans(self) -> typing.Iterator[os.DirEntry]:
+        """
+        Streams the outputs whose source no longer exists.
+        Both trees are walked in the same sorted order and merged, so memory doesn't grow with the size of the library.
+        """
+        output_type = self.config.general.output_type
+        if set(pathlib.Path(self.config.general.root).parts).intersection(self.config.general.exclude_filter):
+            sources: typing.Iterator[tuple[str, ...]] = iter(())
+        else:
+            #sources are ordered by the name of their output, which can sort differently than their own name
+            sources = (parts for parts, entry in scanner.scan_sorted(self.config.general.root, self.config.general.input_types, self.config.general.exclude_filter, lambda name: os.path.splitext(name)[0] + output_type) if not entry.name.startswith("shrinkify_temp"))
+        source = next(sources, None)
+        for parts, entry in scanner.scan_sorted(self.config.general.output, (output_type,)):
+            if entry.name.startswith("shrinkify_temp") or not entry.is_file(): #in-progress conversion
+                continue
+            while source is not None and source < parts:
+                source = next(sources, None)
+            if source != parts:
+                yield entry
+
+    def cleanup(self) -> tuple[int, int]:
+        """Lists (or deletes) outputs without a source, returns their count and total size"""
+        delete = self.config.utils.cleanup.delete and not self.config.utils.cleanup.dry_run
+        count = size = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.config.utils.cleanup.jobs)) as pool:
+            pending: collections.deque[concurrent.futures.Future] = collections.deque()
+            for orphan in self.find_orphans():
+                print(orphan.path)
+                count += 1
+                size += orphan.stat().st_size
+                if delete:
+                    pending.append(pool.submit(os.unlink, orphan.path))
+                    #keep a bounded number of deletions in flight
+                    while len(pending) > self.config.utils.cleanup.jobs*4:
+                        pending.popleft().result()
+            for future in pending:
+                future.result()
+        logging.info(f"{count} orphaned files ({size/1024/1024:.1f} MB){' deleted' if delete else ''}")
+        return count, size
 
     def reorganize_util(self):
-        root = pathlib.Path(self.config.general.root)
-        last_tree = {(f, f.stat().st_size) for f in filter(lambda f: self.is_valid_file(f, exist_ok=True), root.rglob("*"))}
-        retries = 0
-        while True:
+        """
+        Watches root and moves converted files along when their sources are moved or renamed,
+        so reorganizing the library doesn't mean converting it again
+        """
+        root = str(pathlib.Path(self.config.general.root))
+        retry_delay = self.config.utils.reorganize.retry_delay
+        tree = fswatch.DirectoryTree(root, self.config.general.input_types, self.config.general.exclude_filter)
+        #only the digest index is needed, building the metadata parser would set up every handler
+        cache = caching.CacheConnector(self.config)
+        digests = cache.digest_index()
+        moves = fswatch.MoveDetector(tree.all_files(), lambda path: digests.digest(path), retry_delay*self.config.utils.reorganize.retry_count)
+        cache.flush()
+        watcher = fswatch.open_watcher(root, self.config.general.exclude_filter, retry_delay)
+        logging.info(f"Watching {root} for moved files")
+        try:
+            while True:
+                #wake up while moves are half seen so they can be matched or expired
+                changed = watcher.wait(retry_delay if moves.pending else None)
+                removed: dict[str, int] = {}
+                added: dict[str, int] = {}
+                for directory in sorted(changed): #parents before children
+                    dir_removed, dir_added = tree.refresh(directory)
+                    removed.update(dir_removed)
+                    added.update(dir_added)
+                for original, new in moves.update(removed, added):
+                    self.move_output(pathlib.Path(original), pathlib.Path(new))
+                cache.flush()
+        except KeyboardInterrupt:
+            print("Control-C detected, exiting...")
+        finally:
+            watcher.close()
+
+    def watch(self):
+        """
+        Converts files as they appear under root until interrupted, keeping the metadata handlers and caches warm.
+        A file is only converted once its size has stayed the same for `utils.watch.settle_time` seconds,
+        so downloads and copies that are still being written are left alone.
+        """
+        root = str(pathlib.Path(self.config.general.root))
+        settle_time = self.config.utils.watch.settle_time
+        tree = fswatch.DirectoryTree(root, self.config.general.input_types, self.config.general.exclude_filter)
+        #path -> (size, monotonic time the size was last seen changing)
+        settling: dict[str, tuple[int, float]] = {}
+        if self.config.utils.watch.catch_up:
+            settling.update((path, (size, time.monotonic() - settle_time)) for path, size in tree.all_files())
+        watcher = fswatch.open_watcher(root, self.config.general.exclude_filter, self.config.utils.watch.poll_delay)
+        logging.info(f"Watching {root} for new files")
+        try:
+            while True:
+                ready = self._settled(settling, settle_time)
+                songs = [songclass.Song(path) for path in ready if not self.is_converted(path)]
+                if self.manifest is not None:
+                    self.manifest.commit() #outputs adopted by is_converted
+                if songs:
+                    self.metaprocessor.overrides.clear_cache()
+                    self.metaprocessor.prefetch(songs)
+                    self.shrink_songs(songs)
+                changed = watcher.wait(settle_time/2 if settling else None)
+                now = time.monotonic()
+                for directory in sorted(changed):
+                    _, added = tree.refresh(directory)
+                    for path, size in added.items():
+                        settling[path] = (size, now)
+        except KeyboardInterrupt:
+            print("Control-C detected, exiting...")
+        finally:
+            watcher.close()
+
+    @staticmethod
+    def _settled(settling: dict[str, tuple[int, float]], settle_time: float) -> list[pathlib.Path]:
+        '''Removes and returns the files in `settling` whose size hasn't changed for `settle_time` seconds'''
+        now = time.monotonic()
+        ready = []
+        for path, (size, since) in list(settling.items()):
             try:
-                current_tree = {(f, f.stat().st_size) for f in filter(lambda f: self.is_valid_file(f, exist_ok=True), root.rglob("*"))}
-                missing_old = last_tree.difference(current_tree)
-                copied_new = current_tree.difference(last_tree)
-                
-                #TODO: handle different files with same sizes
-                original_files = {path: size for path, size in missing_old}
-                new_files = {size: path for path, size in copied_new}
-                
-                stragglers = set()
-                
-                for original, hash in original_files.items():
-                    if hash not in new_files:
-                        logging.debug(f"Destination file for {original} not found, adding to straggler list")
-                        stragglers.add((original, hash))
-                        continue
-                    new = new_files[hash]
-                    comp_old = self.get_output_file(original)
-                    if not comp_old.is_file():
-                        logging.info("Compressed file doesn't exist, ignoring...")
-                        last_tree = copy.deepcopy(current_tree)
-                        continue
-                    comp_new = self.get_output_file(new)
-                    comp_new.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.copyfile(comp_old, comp_new)
-                    comp_old.unlink()
-                    print(comp_old, '->', comp_new)
-                
-                
-                last_tree = copy.deepcopy(current_tree)
-                last_tree = last_tree.union(stragglers)
-                
-                        
-            except KeyboardInterrupt:
-                print("Control-C detected, exiting...")
-                break
+                current = os.stat(path).st_size
+            except OSError: #gone again
+                del settling[path]
+                continue
+            if current != size:
+                settling[path] = (current, now)
+            elif now - since >= settle_time:
+                del settling[path]
+                ready.append(pathlib.Path(path))
+        return sorted(ready)
+
+    def move_output(self, original: pathlib.Path, new: pathlib.Path):
+        comp_old = self.get_output_file(original)
+        if not comp_old.is_file():
+            logging.info("Compressed file doesn't exist, ignoring...")
+            return
+        comp_new = self.get_output_file(new)
+        comp_new.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(comp_old, comp_new)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            #output on another filesystem, copy next to the destination first so it appears complete
+            temp = comp_new.with_name(f"shrinkify_temp_{uuid.uuid4()}{comp_new.suffix}")
+            shutil.copy2(comp_old, temp)
+            os.replace(temp, comp_new)
+            comp_old.unlink()
+        if self.manifest is not None:
+            self.manifest.forget(original, commit=False)
+            self.manifest.mark(new, comp_new, 'done')
+        print(comp_old, '->', comp_new)
+
+    def is_converted(self, file: pathlib.Path, stat: os.stat_result | None = None) -> bool:
+        if self.manifest is not None:
+            return self.manifest.is_current(file, self.get_output_file(file), stat)
+        return self.get_output_file(file).exists()
 
     def shrink_directory(self, directory: os.PathLike | str, update=False, continue_from: None | os.PathLike | str = None):
         pathdir = pathlib.Path(directory)
-        valid_files = sorted(filter(lambda f: self.is_valid_file(f, exist_ok=update), pathdir.rglob("*")))
+        valid_files = sorted(pathlib.Path(e.path) for e in self.scan_library(pathdir) if update or not self.is_converted(pathlib.Path(e.path), e.stat()))
+        if self.manifest is not None:
+            self.manifest.commit() #outputs adopted during the scan
         #TODO: Force conversion
         logging.debug(tuple(valid_files))
         skip = continue_from is not None
-        for fileno, file in enumerate(valid_files):
+        songs = []
+        for file in valid_files:
             if skip:
                 if continue_from == file or continue_from == self.get_output_file(file):
                     skip = False
                 else:
                     continue
-            logging.info(f"Converting {file.name} ({fileno+1}/{len(valid_files)})")
-            self.shrink_file(songclass.Song(file), update=update)
+            songs.append(songclass.Song(file))
+        #resolve what can be resolved in bulk before the per-file pipeline starts
+        self.metaprocessor.prefetch(songs)
+        return self.shrink_songs(songs, update=update)
+
+    def shrink_songs(self, songs: list[songclass.Song], update: bool = False) -> list[tuple[songclass.Song, BaseException]]:
+        """
+        Converts a batch of songs as a two stage pipeline.
+        Up to `conversion.metadata_jobs` workers resolve metadata and run at most
+        `conversion.prefetch_depth` songs ahead of the `conversion.jobs` encode workers,
+        so network lookups for upcoming songs overlap the encoding of the current ones.
+        A failing song is logged and skipped instead of aborting the batch.
+        Returns the list of (song, exception) pairs that failed.
+        """
+        total = len(songs)
+        jobs = max(1, min(self.config.conversion.jobs, total)) if total else 1
+        metadata_jobs = max(1, min(self.config.conversion.metadata_jobs, total)) if total else 1
+        results: list[concurrent.futures.Future] = [concurrent.futures.Future() for _ in songs]
+        prepared: queue.Queue[tuple[int, songclass.Song] | None] = queue.Queue(maxsize=max(1, self.config.conversion.prefetch_depth))
+        pending = iter(enumerate(songs))
+        pending_lock = threading.Lock()
+        stop = threading.Event()
+
+        def metadata_worker():
+            while not stop.is_set():
+                with pending_lock:
+                    item = next(pending, None)
+                if item is None:
+                    return
+                fileno, song = item
+                try:
+                    song = self._prepare_job(song, update, fileno, total)
+                except Exception as e:
+                    results[fileno].set_exception(e)
+                    continue
+                prepared.put((fileno, song))
+
+        def encode_worker():
+            while True:
+                item = prepared.get()
+                if item is None:
+                    return
+                fileno, song = item
+                if stop.is_set(): #drain the queue without starting new encodes
+                    results[fileno].cancel()
+                    continue
+                try:
+                    self._encode_job(song, update, fileno, total)
+                except Exception as e:
+                    results[fileno].set_exception(e)
+                else:
+                    results[fileno].set_result(song)
+
+        start = time.monotonic()
+        metadata_threads = [threading.Thread(target=metadata_worker, name=f"shrinkify-metadata-{i}") for i in range(metadata_jobs)]
+        encode_threads = [threading.Thread(target=encode_worker, name=f"shrinkify-encode-{i}") for i in range(jobs)]
+        for thread in metadata_threads + encode_threads:
+            thread.start()
+        failures: list[tuple[songclass.Song, BaseException]] = []
+        try:
+            #report in submission order so the log reads the same regardless of job count
+            for fileno, (song, future) in enumerate(zip(songs, results)):
+                exc = future.exception()
+                if exc is not None:
+                    logging.error(f"({fileno+1}/{total}) Failed to convert {song.path.name}: {type(exc).__name__} {exc}")
+                    failures.append((song, exc))
+                    metrics.count("songs", result="failed")
+                    if self.manifest is not None and not update:
+                        self.manifest.mark(song.path, self.get_output_file(song.path), 'failed')
+                else:
+                    logging.debug(f"({fileno+1}/{total}) Finished {song.path.name}")
+                    metrics.count("songs", result="converted")
+        except KeyboardInterrupt:
+            print("Control-C detected, waiting for running conversions to finish...")
+            stop.set()
+            raise
+        finally:
+            for thread in metadata_threads:
+                thread.join()
+            for _ in encode_threads:
+                prepared.put(None)
+            for thread in encode_threads:
+                thread.join()
+            self.metaprocessor.cache.flush()
+        elapsed = time.monotonic() - start
+        logging.info(f"Converted {total-len(failures)}/{total} files in {elapsed:.1f}s using {jobs} job(s)")
+        for song, exc in failures:
+            logging.info(f"Failed: {song.path} ({type(exc).__name__} {exc})")
+        self.write_metrics()
+        return failures
+
+    def write_metrics(self):
+        '''Writes the run report and Prometheus textfile, if they are configured'''
+        try:
+            if self.config.general.metrics_report:
+                metrics.recorder.write_report(self.config.general.metrics_report)
+            if self.config.general.metrics_textfile:
+                metrics.recorder.write_textfile(self.config.general.metrics_textfile)
+        except OSError as e:
+            logging.warning(f"Could not write metrics: {e}")
+
+    def warm_cache(self, directory: os.PathLike | str) -> int:
+        """
+        Resolves metadata and cover art for every convertable file in `directory` without converting anything,
+        so a later conversion run finds everything in the cache. Returns the number of files that failed.
+        """
+        files = sorted(pathlib.Path(e.path) for e in self.scan_library(directory))
+        failed = 0
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.config.conversion.metadata_jobs)) as pool:
+                futures = [pool.submit(self.metaprocessor.parse, songclass.Song(file)) for file in files]
+                for fileno, (file, future) in enumerate(zip(files, futures)):
+                    try:
+                        song = future.result()
+                        if song.cover_image is not None:
+                            self.covers.get(song.cover_image)
+                    except Exception as e:
+                        logging.error(f"({fileno+1}/{len(files)}) Failed to resolve {file.name}: {type(e).__name__} {e}")
+                        failed += 1
+                    else:
+                        logging.info(f"({fileno+1}/{len(files)}) Cached {file.name}")
+        finally:
+            self.metaprocessor.cache.flush()
+        return failed
+
+    def _prepare_job(self, song: songclass.Song, update: bool, fileno: int, total: int) -> songclass.Song:
+        logging.debug(f"Resolving metadata for {song.path.name} ({fileno+1}/{total})")
+        try:
+            with metrics.span("prepare"):
+                return self.prepare_song(song, update=update)
+        except Exception:
+            logging.debug(f"Traceback for {song.path}", exc_info=True)
+            raise
+
+    def _encode_job(self, song: songclass.Song, update: bool, fileno: int, total: int):
+        logging.info(f"Converting {song.path.name} ({fileno+1}/{total})")
+        try:
+            with metrics.span("encode"):
+                self.encode_song(song, update=update)
+        except Exception:
+            logging.debug(f"Traceback for {song.path}", exc_info=True)
+            raise
 
     def shrink_file(self, song: songclass.Song, update: bool = False):
+        song = self.prepare_song(song, update=update)
+        self.encode_song(song, update=update)
+
+    def prepare_song(self, song: songclass.Song, update: bool = False) -> songclass.Song:
+        """
+        Resolves the paths, metadata and cover image of a song without touching ffmpeg
+        """
         #updating runs inplace, so find the child file and use it as the source
         if update and not song.path.is_relative_to(self.output):
             song.path = pathlib.Path(self.output, song.path.parent.relative_to(self.root)).with_suffix(self.config.general.output_type)
             if not song.path.is_file():
                 raise RuntimeError(f"Tried to update {song}'s converted file but the converted file doesn't exist")
 
-        song.output = pathlib.Path(song.path.parent, "shrinkify_temp").with_suffix(self.config.general.output_type)
+        #unique per job so parallel conversions in one directory don't clobber each other
+        song.output = pathlib.Path(song.path.parent, f"shrinkify_temp_{uuid.uuid4().hex}").with_suffix(self.config.general.output_type)
         
         logging.info("parsing metadata")
-        song = self.metaprocessor.parse(song)
+        with metrics.span("metadata"):
+            song = self.metaprocessor.parse(song)
         if not song.cover_image:
             logging.error("No cover image defined, creating emergency image")
             song.cover_image = Image.new("RGBA", (100, 100), "red")
-        if self.config.conversion.rescale:
-            song.cover_image.thumbnail(self.config.conversion.rescale)
-        song.cover_image = song.cover_image.convert("RGBA")
+        with metrics.span("cover"):
+            song.cover_art = self.covers.get(song.cover_image)
         logging.debug(song)
+        return song
+
+    def encode_song(self, song: songclass.Song, update: bool = False):
+        """
+        Encodes a song prepared by `prepare_song` and moves it into the output tree
+        """
+        try:
+            self._encode(song, update)
+        except BaseException:
+            #don't leave half-written temp files behind in the library
+            if song.output_resolved:
+                song.output_resolved.unlink(missing_ok=True)
+            raise
+        
+        logging.info(f"{song}: finished conversion")
+
+        dummy_output = song.output
+        if not dummy_output:
+            raise RuntimeError("Song output is unset despite needing to be set before")
+
+        with metrics.span("rename"):
+            song.output = self.get_output_file(song.path)
+            song.output.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                dummy_output.rename(song.output)
+            except FileExistsError:
+                #make sure nothing is deleted without another copy existing 
+                song.output.rename(song.output.with_stem("_"+song.output.stem))
+                dummy_output.rename(song.output)
+                song.output.with_stem("_"+song.output.stem).unlink(missing_ok=True)
+            if self.manifest is not None and not update:
+                self.manifest.mark(song.path, song.output, 'done')
+        
+        time.sleep(self.config.conversion.throttle)
 
+    def _encode(self, song: songclass.Song, update: bool = False):
+        if self.config.conversion.tag_mode == 'ffmpeg':
+            try:
+                convert_cmd, ffmpeg_stdin = self.build_tagged_command(song, update)
+                self._run_ffmpeg(song, convert_cmd, ffmpeg_stdin)
+                return
+            except RuntimeError as e:
+                logging.warning(f"{song}: single pass encode failed, falling back to mutagen tagging ({e})")
+        self._run_ffmpeg(song, self.build_command(song, update))
+        self._tag_with_mutagen(song)
 
+    def build_command(self, song: songclass.Song, update: bool = False) -> list[str]:
         convert_cmd_base = copy.deepcopy(self.config.conversion.conversion_args)
         convert_cmd = []
         for argument in convert_cmd_base:
@@ -157,30 +494,59 @@ class Shrinkify(object):
                 ))
             else:
                 raise TypeError("Invalid type in convert list")
-        # convert_cmd = []
-        # convert_cmd.extend(copy.copy(self.config.conversion.pre_args))
-        # convert_cmd.extend(['-i', str(song.resolved), '-i', '-'])
-        # convert_cmd.extend(copy.copy(self.config.conversion.mid_args))
-        # if update:
-        #     convert_cmd.extend(['-a:c', 'copy'])
-        # if not MUTAGEN_ENABLED:
-        #     for k, v in song.metadata.items():
-        #         if isinstance(v, list): #multi-value tags
-        #             v = ", ".join(v)
-        #         convert_cmd.extend(['-metadata', f"{k}={v}"])
-        # convert_cmd.append(str(song.output_resolved))
+        return convert_cmd
+
+    def build_tagged_command(self, song: songclass.Song, update: bool = False) -> tuple[list[str], bytes]:
+        """
+        Builds an ffmpeg command that writes the tags and cover art itself, so the output is only written once.
+        Returns the command and the data to send to ffmpeg's stdin.
+        m4a takes the cover as an attached picture piped through stdin and the tags as -metadata arguments,
+        ogg takes everything (including the cover as METADATA_BLOCK_PICTURE) as an ffmetadata document through stdin.
+        Multi-value tags are joined with ", " as ffmpeg can only store one value per key,
+        and ffmpeg always writes its own encoder tag, so the parser name is only recorded in mutagen mode.
+        """
+        tags = {k: ", ".join(v) if isinstance(v, list) else str(v) for k, v in song.metadata.items()}
+        convert_cmd = copy.copy(self.config.conversion.pre_args)
+        convert_cmd.extend(['-i', str(song.resolved)])
+        if self.config.general.output_type == '.m4a':
+            if 'year' in tags: #ffmpeg only knows the mp4 date atom as "date"
+                tags.setdefault('date', tags.pop('year'))
+            convert_cmd.extend(['-f', 'image2pipe', '-i', 'pipe:0'])
+            convert_cmd.extend(copy.copy(self.config.conversion.mid_args))
+            for k, v in tags.items():
+                convert_cmd.extend(['-metadata', f"{k}={v}"])
+            ffmpeg_stdin = self._cover_art(song).data
+        elif self.config.general.output_type == '.ogg':
+            tags['metadata_block_picture'] = self._cover_art(song).picture_block()
+            convert_cmd.extend(['-f', 'ffmetadata', '-i', 'pipe:0', '-map', '0:a:0', '-map_metadata', '1'])
+            ffmpeg_stdin = ffmetadata_document(tags)
+        else:
+            raise RuntimeError(f"Unsupported output format for single pass tagging: {self.config.general.output_type}")
+        if update:
+            convert_cmd.extend(['-c:a', 'copy'])
+        convert_cmd.append(str(song.output_resolved))
+        return convert_cmd, ffmpeg_stdin
+
+    def _run_ffmpeg(self, song: songclass.Song, convert_cmd: list[str], ffmpeg_stdin: bytes | None = None):
         logging.debug(f"{song}: command list: {convert_cmd}")
         logging.info(f"{song}: beginning conversion")
+        with metrics.span("ffmpeg"):
+            ffmpeg_proc = subprocess.Popen(convert_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
+            #communicate instead of wait so a chatty ffmpeg can't fill the stderr pipe and deadlock
+            ffmpeg_stdout, ffmpeg_stderr = ffmpeg_proc.communicate(ffmpeg_stdin)
+        if ffmpeg_proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with code {ffmpeg_proc.returncode}: {ffmpeg_stderr.decode('utf8', 'replace').strip()[-500:]}")
 
-        ffmpeg_stdin = io.BytesIO()
-        ffmpeg_proc = subprocess.Popen(convert_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
+    def _cover_art(self, song: songclass.Song) -> coverart.CoverArt:
+        if song.cover_art is None:
+            song.cover_art = self.covers.get(song.cover_image)
+        return song.cover_art
 
-        # song.cover_image.save(ffmpeg_stdin, format=self.config.conversion.thumbnail_format.strip("."))
-        # ffmpeg_stdin.seek(0)
-
-        # ffmpeg_stdout, ffmpeg_stderr = ffmpeg_proc.communicate(ffmpeg_stdin.read())
-        ffmpeg_proc.wait()
+    def _tag_with_mutagen(self, song: songclass.Song):
+        with metrics.span("tag"):
+            self._write_mutagen_tags(song)
 
+    def _write_mutagen_tags(self, song: songclass.Song):
         logging.debug("starting mutagen metadata adder thing")
         if self.config.general.output_type == '.m4a':
             muta_file = mutagen.easymp4.EasyMP4(song.output_resolved)
@@ -202,40 +568,8 @@ class Shrinkify(object):
             for k, v in song.metadata.items():
                 muta_file.tags[k] = v
             #add thumbnail
-            raw = io.BytesIO()
-            song.cover_image.save(raw, format="png")
-            raw.seek(0)
-            img = mutagen.flac.Picture()
-            img.data = raw.read()
-            img.type = 3
-            img.desc = "Cover (front)"
-            img.mime = "image/png"
-            img.width = song.cover_image.width
-            img.height = song.cover_image.height
-            img.depth = 32
-            picture_data = img.write()
-            encoded_data = base64.b64encode(picture_data)
-            vcomment_value = encoded_data.decode("ascii")
-            muta_file.tags['metadata_block_picture'] = [vcomment_value]
+            muta_file.tags['metadata_block_picture'] = [self._cover_art(song).picture_block()]
             
             muta_file.save()
         else:
             raise RuntimeError(f"Unsupported output format for mutagen metadata: {self.config.general.output_type}")
-        
-        logging.info(f"{song}: finished conversion")
-
-        dummy_output = song.output
-        if not dummy_output:
-            raise RuntimeError("Song output is unset despite needing to be set before")
-
-        song.output = self.get_output_file(song.path)
-        song.output.parent.mkdir(parents=True, exist_ok=True)
-        try:
-            dummy_output.rename(song.output)
-        except FileExistsError:
-            #make sure nothing is deleted without another copy existing 
-            song.output.rename(song.output.with_stem("_"+song.output.stem))
-            dummy_output.rename(song.output)
-            song.output.with_stem("_"+song.output.stem).unlink(missing_ok=True)
-        
-        time.sleep(self.config.conversion.throttle)
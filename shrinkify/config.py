@@ -21,15 +21,31 @@ class General(ConfigGroup):
     cache_dir: os.PathLike | str = pathlib.Path("~/.cache/shrinkify/").expanduser()
     cache_file: os.PathLike | str = pathlib.Path("~/.cache/shrinkify/cache.sqlite").expanduser()
     use_cache: bool = True
+    cache_journal_mode: str = 'wal'
+    cache_busy_timeout: int = 5000 #ms
+    cache_commit_interval: int = 50 #cache writes per commit
+    cache_commit_delay: float = 1 #seconds a write may stay uncommitted, an open write transaction locks out other processes
+    cache_ttl: dict[str, int] = field(default_factory=lambda: {'ytmSearchCache': 7*86400, 'ytmArtistCache': 30*86400, 'ytmArtistAlbumCache': 30*86400, 'ytmDiscographyIndex': 30*86400}) #seconds per table
+    cache_max_size: int | None = None #MB, enforced by `shrinkify cache prune`
+    manifest_file: os.PathLike | str = pathlib.Path("~/.cache/shrinkify/manifest.sqlite").expanduser()
+    use_manifest: bool = True
     input_types: tuple[str, ...] = ('.mp3', '.mp4', '.mkv', '.webm', '.m4a', '.aac', '.wav', '.ogg', '.opus', '.flac')
     output_type: str = '.ogg'
     exclude_filter: tuple[str, ...] = ('compressed',)
     loglevel: int = logging.INFO
+    metrics_report: os.PathLike | str | None = None #json report of per-stage timings written after each run
+    metrics_textfile: os.PathLike | str | None = None #the same as a Prometheus textfile, e.g. for node_exporter's textfile collector
     
 @dataclass
 class Conversion(ConfigGroup):
     throttle: int = 0
-    thumbnail_format: str = '.png'
+    jobs: int = 1
+    metadata_jobs: int = 1
+    prefetch_depth: int = 4
+    thumbnail_format: str = '.png' #'.png' or '.jpg'
+    thumbnail_quality: int = 90 #jpeg only
+    cover_cache_size: int = 64
+    tag_mode: str = 'mutagen' #'mutagen' tags after encoding, 'ffmpeg' tags while encoding
     rescale: None | tuple[int, int] = (750, 750)
     conversion_args: list[str | EllipsisType] = field(default_factory=lambda: ['ffmpeg', '-y', '-i', '{INPUT}', '-vn', ..., '{OUTPUT}'])
     pre_args: list[str] = field(default_factory=lambda: ['ffmpeg', '-y'])
@@ -37,6 +53,7 @@ class Conversion(ConfigGroup):
 
 @dataclass
 class FileMetadata(ConfigGroup):
+    probe_backend: str = 'mutagen' #'ffprobe' to always spawn ffprobe
     ffprobe_command: tuple[str, ...] = ('ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams')
     ffthumb_pre_command: tuple[str, ...] = ('ffmpeg', '-i')
     ffthumb_post_command: tuple[str, ...] = ('-an', '-map', '0:v:0', '-vframes', '1', '-c:v', 'png', '-f', 'image2pipe', '-')
@@ -59,6 +76,7 @@ class NicoNicoMetadata(ConfigGroup):
 class YoutubeMusicMetadata(ConfigGroup):
     filename_regex: tuple[str, ...] = (r"-([a-zA-Z0-9\-_]{11})\.", r"\[([a-zA-Z0-9\-_]{11})\]\.")
     use_very_inaccurate: bool = False
+    memo_size: int = 256 #decoded api responses kept in memory, 0 to disable
 
 @dataclass
 class AcoustIDMetadata(ConfigGroup):
@@ -67,6 +85,11 @@ class AcoustIDMetadata(ConfigGroup):
     score_threshold: float = 0.6
     special_exclude: tuple[str, ...] = tuple()
     musicbrainz_agent: str = "Shrinkify/0.1.0 ( aipacifico24@gmail.com )"
+    musicbrainz_rate: float = 1.0 #requests per second
+    max_retries: int = 3 #retries of rate limited (429/503) requests
+    prefetch: bool = False #fingerprint and look up every file before converting, even ones an earlier handler would have claimed
+    fingerprint_jobs: int | None = None #processes used to fingerprint files when prefetching, defaults to the cpu count
+    lookup_batch_size: int = 20 #fingerprints per AcoustID lookup request
 
 @dataclass
 class Reorganize(ConfigGroup):
@@ -89,14 +112,23 @@ class Tests(ConfigGroup):
 @dataclass
 class Cleanup(ConfigGroup):
     delete: bool = False
+    dry_run: bool = False #only report what delete would remove
+    jobs: int = 8 #files deleted at once
 
 @dataclass
 class Sort(ConfigGroup):
     sort_dir: os.PathLike | str = "DEFAULT"
 
+@dataclass
+class Watch(ConfigGroup):
+    settle_time: float = 5 #seconds a file's size has to stay the same before it is converted
+    poll_delay: float = 1 #used when inotify is unavailable
+    catch_up: bool = True #convert files that were added while not watching on startup
+
 @dataclass
 class Utils(ConfigGroup):
     reorganize: Reorganize = field(default_factory=Reorganize)
+    watch: Watch = field(default_factory=Watch)
     cleanup: Cleanup = field(default_factory=Cleanup)
     sort: Sort = field(default_factory=Sort)
 
@@ -119,7 +151,7 @@ def load_dict(data: dict, conf: ConfigGroup):
         if not isinstance(key, str) or not hasattr(conf, key):
             logging.warning(f"Invalid key: {key}")
             continue
-        if isinstance(data[key], dict):
+        if isinstance(data[key], dict) and isinstance(getattr(conf, key), ConfigGroup):
             load_dict(data[key], getattr(conf, key))
         else:
             setattr(conf, key, data[key])
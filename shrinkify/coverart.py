@@ -0,0 +1,126 @@
+import base64
+import collections
+import hashlib
+import io
+import logging
+import os
+import pathlib
+import threading
+from PIL import Image
+import mutagen.flac
+from . import config
+from . import metrics
+from .utils import atomicfile
+
+IMAGE_FORMATS = {
+    '.png': ('PNG', 'image/png'),
+    '.jpg': ('JPEG', 'image/jpeg'),
+    '.jpeg': ('JPEG', 'image/jpeg'),
+}
+
+class CoverArt(object):
+    """A cover image that has already been rescaled and encoded for embedding"""
+    def __init__(self, data: bytes, mime: str, width: int, height: int, depth: int) -> None:
+        self.data = data
+        self.mime = mime
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self._picture_block: str | None = None
+
+    def picture_block(self) -> str:
+        """The cover as a base64 FLAC picture block, the way vorbis comments store it"""
+        if self._picture_block is None:
+            img = mutagen.flac.Picture()
+            img.data = self.data
+            img.type = 3
+            img.desc = "Cover (front)"
+            img.mime = self.mime
+            img.width = self.width
+            img.height = self.height
+            img.depth = self.depth
+            self._picture_block = base64.b64encode(img.write()).decode("ascii")
+        return self._picture_block
+
+class CoverArtCache(object):
+    """
+    Rescales and encodes cover images once per distinct image and settings.
+    Tracks that share art (usually a whole album) reuse the encoded bytes, which are kept in memory
+    and spilled to `cache_dir/covers` so later runs can skip the work too.
+    """
+    def __init__(self, conf: config.Config) -> None:
+        self.conf = conf
+        if self.conf.conversion.thumbnail_format not in IMAGE_FORMATS:
+            raise RuntimeError(f"Unsupported thumbnail format {self.conf.conversion.thumbnail_format}")
+        self.format, self.mime = IMAGE_FORMATS[self.conf.conversion.thumbnail_format]
+        self.spill_dir = pathlib.Path(self.conf.general.cache_dir, "covers") if self.conf.general.use_cache else None
+        self.entries: collections.OrderedDict[str, CoverArt] = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, image: Image.Image) -> str:
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{image.mode}:{image.size}:{self.conf.conversion.rescale}:{self.format}:{self.conf.conversion.thumbnail_quality}".encode('utf8'))
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def get(self, image: Image.Image) -> CoverArt:
+        key = self.key(image)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                metrics.count("cover_lookups", result="hit")
+                return self.entries[key]
+        art = self.load(key)
+        if art is None:
+            metrics.count("cover_lookups", result="miss")
+            art = self.encode(image)
+            self.spill(key, art)
+        else:
+            metrics.count("cover_lookups", result="spill")
+        with self.lock:
+            self.entries[key] = art
+            while len(self.entries) > max(1, self.conf.conversion.cover_cache_size):
+                self.entries.popitem(last=False)
+        return art
+
+    def encode(self, image: Image.Image) -> CoverArt:
+        image = image.copy()
+        if self.conf.conversion.rescale:
+            image.thumbnail(self.conf.conversion.rescale)
+        #jpeg has no alpha channel
+        image = image.convert("RGB" if self.format == 'JPEG' else "RGBA")
+        raw = io.BytesIO()
+        if self.format == 'JPEG':
+            image.save(raw, format=self.format, quality=self.conf.conversion.thumbnail_quality, optimize=True)
+        else:
+            image.save(raw, format=self.format)
+        return CoverArt(raw.getvalue(), self.mime, image.width, image.height, 24 if self.format == 'JPEG' else 32)
+
+    def spill_file(self, key: str) -> pathlib.Path | None:
+        if self.spill_dir is None:
+            return None
+        return pathlib.Path(self.spill_dir, key[:2], key).with_suffix(self.conf.conversion.thumbnail_format)
+
+    def load(self, key: str) -> CoverArt | None:
+        spill_file = self.spill_file(key)
+        if spill_file is None or not spill_file.is_file():
+            return None
+        data = spill_file.read_bytes()
+        os.utime(spill_file) #the mtime doubles as the last access time for cache pruning
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                width, height = img.size
+        except OSError:
+            logging.warning(f"Ignoring unreadable cached cover {spill_file}")
+            return None
+        return CoverArt(data, self.mime, width, height, 24 if self.format == 'JPEG' else 32)
+
+    def spill(self, key: str, art: CoverArt):
+        spill_file = self.spill_file(key)
+        if spill_file is None:
+            return
+        try:
+            #a concurrent reader never sees a partial image
+            atomicfile.write_atomic(spill_file, art.data)
+        except OSError as e:
+            logging.warning(f"Could not write cover cache file {spill_file}: {e}")
@@ -6,6 +6,7 @@ import logging
 from . import Shrinkify
 from . import config
 from . import songclass
+from .metadata import caching
 from .utils import sortutil
 
 def main():
@@ -51,6 +52,8 @@ class CommandLineExec(object):
         parser.add_argument("--cachedir", dest="c.general.cache_dir", type=pathlib.Path, default=self.conf.general.cache_dir)
         parser.add_argument("--cachefile", dest="c.general.cache_file", type=pathlib.Path, default=self.conf.general.cache_file)
         parser.add_argument("--disable-cache", dest="c.general.use_cache", action='store_false', default=self.conf.general.use_cache)
+        parser.add_argument("--manifest", dest="c.general.manifest_file", type=pathlib.Path, default=self.conf.general.manifest_file)
+        parser.add_argument("--disable-manifest", dest="c.general.use_manifest", action='store_false', default=self.conf.general.use_manifest, help="Check for existing outputs instead of using the conversion manifest")
         parser.add_argument("-i", "--input-types", dest="c.general.input_types", default=self.conf.general.input_types, nargs='*', type=str)
         parser.add_argument("-t", "--output-type", dest="c.general.output_type", default=self.conf.general.output_type, type=str)
         parser.add_argument("-e", "--exclude", dest="c.general.exclude_filter", default=self.conf.general.exclude_filter, nargs='*', type=str)
@@ -59,20 +62,34 @@ class CommandLineExec(object):
     
     def add_convert_opts(self, parser: argparse.ArgumentParser):
         parser.add_argument("-w", "--throttle", dest="c.conversion.throttle", default=self.conf.conversion.throttle, type=int)
+        parser.add_argument("-j", "--jobs", dest="c.conversion.jobs", default=self.conf.conversion.jobs, type=int, help="Number of files to convert at once")
+        parser.add_argument("--metadata-jobs", dest="c.conversion.metadata_jobs", default=self.conf.conversion.metadata_jobs, type=int, help="Number of files to fetch metadata for at once")
+        parser.add_argument("--prefetch", dest="c.conversion.prefetch_depth", default=self.conf.conversion.prefetch_depth, type=int, help="How many files metadata fetching may run ahead of conversion")
         parser.add_argument("--thumbnail-format", dest="c.conversion.thumbnail_format", default=self.conf.conversion.thumbnail_format, type=str)
+        parser.add_argument("--thumbnail-quality", dest="c.conversion.thumbnail_quality", default=self.conf.conversion.thumbnail_quality, type=int)
+        parser.add_argument("--tag-mode", dest="c.conversion.tag_mode", default=self.conf.conversion.tag_mode, choices=('mutagen', 'ffmpeg'), help="ffmpeg writes tags and covers during encoding instead of rewriting the output afterwards")
         parser.add_argument("--ffmpeg-pre-args", dest="c.conversion.pre_args", default=self.conf.conversion.pre_args, nargs='*', type=str, help="Do not use unless you know what you are doing")
         parser.add_argument("--ffmpeg-mid-args", dest="c.conversion.mid_args", default=self.conf.conversion.mid_args, nargs='*', type=str, help="Do not use unless you know what you are doing")
+        parser.add_argument("--metrics-report", dest="c.general.metrics_report", default=self.conf.general.metrics_report, type=pathlib.Path, help="Write per-stage timings of the run to this json file")
+        parser.add_argument("--metrics-textfile", dest="c.general.metrics_textfile", default=self.conf.general.metrics_textfile, type=pathlib.Path, help="Write per-stage timings of the run as a Prometheus textfile")
         self.add_metadata_opts(parser)
         return parser
 
     def add_metadata_opts(self, parser: argparse.ArgumentParser):
         parser.add_argument("-y", "--youtube-api-key", dest="c.metadata.youtube.api_key", default=self.conf.metadata.youtube.api_key, type=str)
+        parser.add_argument("--acoustid-prefetch", dest="c.metadata.acoustid.prefetch", action='store_true', default=self.conf.metadata.acoustid.prefetch, help="Fingerprint and look up every file in bulk before converting")
         return parser
 
     def add_cleanup_opts(self, parser: argparse.ArgumentParser):
         parser.add_argument("--delete", dest='c.utils.cleanup.delete', help="Delete files instead of listing them", action='store_true')
+        parser.add_argument("--dry-run", dest='c.utils.cleanup.dry_run', help="With --delete, only report what would be deleted", action='store_true')
+        parser.add_argument("-j", "--jobs", dest='c.utils.cleanup.jobs', default=self.conf.utils.cleanup.jobs, type=int, help="Number of files to delete at once")
         return parser
     
+    def add_cache_opts(self, parser: argparse.ArgumentParser):
+        parser.add_argument("--max-size", dest="c.general.cache_max_size", default=self.conf.general.cache_max_size, type=int, help="Cache size budget in MB used by prune")
+        return parser
+
     def add_sortutil_opts(self, parser: argparse.ArgumentParser):
         parser.add_argument("c.utils.sort.sort_dir")
         return parser
@@ -94,13 +111,30 @@ class CommandLineExec(object):
         if len(parse_namespace.files) == 0:
             shrink.shrink_directory(self.conf.general.root, update=parse_namespace.in_place, continue_from=parse_namespace.continue_from)
         else:
+            songs = []
             for file in parse_namespace.files:
                 file = pathlib.Path(file).expanduser()
                 if file.is_dir():
                     shrink.shrink_directory(file, update=parse_namespace.in_place, continue_from=parse_namespace.continue_from)
                 elif file.is_file():
-                    shrink.shrink_file(songclass.Song(file), update=parse_namespace.in_place)
+                    songs.append(songclass.Song(file))
+            if songs:
+                shrink.metaprocessor.prefetch(songs)
+                shrink.shrink_songs(songs, update=parse_namespace.in_place)
     
+    def parse_watch(self, argv: list[str]):
+        parser = argparse.ArgumentParser()
+        self.add_general_opts(parser)
+        self.add_convert_opts(parser)
+        parser.add_argument("--settle", dest="c.utils.watch.settle_time", default=self.conf.utils.watch.settle_time, type=float, help="Seconds a file has to stay unchanged before it is converted")
+        parser.add_argument("--no-catch-up", dest="c.utils.watch.catch_up", action='store_false', default=self.conf.utils.watch.catch_up, help="Only convert files that appear while watching")
+        parse_namespace = RecursiveNamespace(c=self.conf)
+        parse_namespace = parser.parse_args(argv, namespace=parse_namespace)
+        logging.getLogger().setLevel(parse_namespace.c.general.loglevel)
+        logging.debug(parse_namespace)
+        shrink = Shrinkify(self.conf)
+        shrink.watch()
+
     def parse_reorganize(self, argv: list[str]):
         parser = argparse.ArgumentParser()
         self.add_general_opts(parser)
@@ -122,6 +156,37 @@ class CommandLineExec(object):
         shrink = Shrinkify(self.conf)
         shrink.cleanup()
 
+    def parse_cache(self, argv: list[str]):
+        parser = argparse.ArgumentParser()
+        self.add_general_opts(parser)
+        self.add_cache_opts(parser)
+        parser.add_argument("--metadata-jobs", dest="c.conversion.metadata_jobs", default=self.conf.conversion.metadata_jobs, type=int)
+        self.add_metadata_opts(parser)
+        parser.add_argument('action', choices=('stats', 'prune', 'vacuum', 'warm'), help="warm resolves metadata for every file in root without converting")
+        parse_namespace = RecursiveNamespace(c=self.conf)
+        parse_namespace = parser.parse_args(argv, namespace=parse_namespace)
+        logging.getLogger().setLevel(parse_namespace.c.general.loglevel)
+        logging.debug(parse_namespace)
+        if parse_namespace.action == 'warm':
+            shrink = Shrinkify(self.conf)
+            shrink.warm_cache(self.conf.general.root)
+            return
+        cache = caching.CacheConnector(self.conf)
+        if parse_namespace.action == 'stats':
+            for entry in cache.stats():
+                lookups = entry['hits'] + entry['misses']
+                ratio = f"{entry['hits']/lookups:.1%}" if lookups else "-"
+                print(f"{entry['table']:<24} {entry['rows']:>8} entries {entry['bytes']/1024/1024:>10.2f} MB  hit ratio {ratio}")
+        elif parse_namespace.action == 'prune':
+            removed = cache.prune()
+            for table, count in removed.items():
+                print(f"{table}: removed {count} entries")
+            if not removed:
+                print("Nothing to prune")
+        elif parse_namespace.action == 'vacuum':
+            before, after = cache.vacuum()
+            print(f"{self.conf.general.cache_file}: {before/1024/1024:.2f} MB -> {after/1024/1024:.2f} MB")
+
     def parse_sort(self, argv: list[str]):
         parser = argparse.ArgumentParser()
         self.add_general_opts(parser)
@@ -136,10 +201,14 @@ class CommandLineExec(object):
         logging.debug(argv)
         if len(argv) < 2 or argv[1] in ("shrink", "s"):
             self.parse_shrink(argv[2:])
+        elif argv[1] in ("watch", "w"):
+            self.parse_watch(argv[2:])
         elif argv[1] in ("reorganize", "r"):
             self.parse_reorganize(argv[2:])
         elif argv[1] in ("cleanup", "c"):
             self.parse_cleanup(argv[2:])
+        elif argv[1] == "cache":
+            self.parse_cache(argv[2:])
         elif argv[1] in ("sort", "o"):
             self.parse_sort(argv[2:])
         else:
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from . import config
+
+class ConversionManifest(object):
+    """
+    Remembers which sources have been converted, from which version of the file and with which settings,
+    so incremental runs only have to look at sources that are new or changed.
+    """
+    def __init__(self, conf: config.Config) -> None:
+        self.conf = conf
+        self.profile = self.profile_hash(conf)
+        pathlib.Path(self.conf.general.manifest_file).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.conf.general.manifest_file, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS conversionManifest (
+                    source STRING PRIMARY KEY NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    profile STRING NOT NULL,
+                    output STRING NOT NULL,
+                    status STRING NOT NULL,
+                    updated REAL NOT NULL
+                );""")
+            self.db.commit()
+        self._entries: dict[str, tuple[int, int, str, str, str]] | None = None
+
+    @staticmethod
+    def profile_hash(conf: config.Config) -> str:
+        '''Hash of every setting that changes the bytes of an output file'''
+        profile = {
+            'tag_mode': conf.conversion.tag_mode,
+            #ffmpeg tagging builds the command from pre/mid_args and falls back to conversion_args
+            'conversion_args': [a if isinstance(a, str) else repr(a) for a in conf.conversion.conversion_args],
+            'pre_args': conf.conversion.pre_args if conf.conversion.tag_mode == 'ffmpeg' else None,
+            'mid_args': conf.conversion.mid_args if conf.conversion.tag_mode == 'ffmpeg' else None,
+            'output_type': conf.general.output_type,
+            'rescale': conf.conversion.rescale,
+            'thumbnail_format': conf.conversion.thumbnail_format,
+            'thumbnail_quality': conf.conversion.thumbnail_quality,
+        }
+        return hashlib.sha1(json.dumps(profile, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+    @property
+    def entries(self) -> dict[str, tuple[int, int, str, str, str]]:
+        #one query for the whole table instead of one per file
+        if self._entries is None:
+            with self.lock:
+                rows = self.db.execute("SELECT source, size, mtime_ns, profile, output, status FROM conversionManifest").fetchall()
+            self._entries = {r[0]: tuple(r[1:]) for r in rows} #type:ignore
+        return self._entries
+
+    def is_current(self, source: pathlib.Path, output: pathlib.Path, stat: os.stat_result | None = None) -> bool:
+        '''
+        Returns True if `source` was already converted from its current contents with the current settings into `output`,
+        and `output` still exists. Sources converted before the manifest existed are adopted the first time they are seen.
+        '''
+        stat = stat if stat is not None else source.stat()
+        entry = self.entries.get(str(source))
+        if entry is None:
+            if output.exists():
+                self.mark(source, output, 'done', stat, commit=False)
+                return True
+            return False
+        size, mtime_ns, profile, stored_output, status = entry
+        if status != 'done' or size != stat.st_size or mtime_ns != stat.st_mtime_ns or profile != self.profile or stored_output != str(output):
+            return False
+        #the output may have been deleted or the output directory moved since
+        return output.exists()
+
+    def mark(self, source: pathlib.Path, output: pathlib.Path, status: str, stat: os.stat_result | None = None, commit: bool = True):
+        try:
+            stat = stat if stat is not None else source.stat()
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        except FileNotFoundError:
+            size = mtime_ns = -1
+        row = (str(source), size, mtime_ns, self.profile, str(output), status, time.time())
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO conversionManifest VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+            if commit:
+                self.db.commit()
+            if self._entries is not None:
+                self._entries[row[0]] = row[1:6] #type:ignore
+
+    def forget(self, source: pathlib.Path, commit: bool = True):
+        with self.lock:
+            self.db.execute("DELETE FROM conversionManifest WHERE source = ?", (str(source),))
+            if commit:
+                self.db.commit()
+            if self._entries is not None:
+                self._entries.pop(str(source), None)
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
@@ -1,15 +1,23 @@
+import importlib
 import logging
+import threading
 from .. import config
 from .. import songclass
 from .. import overrides
+from .. import metrics
 import pathlib
 from . import file
-from . import youtube
 from . import caching
-from . import youtubemusic
-from . import niconico
-from . import acoustid_mb
 from abc import ABC, abstractmethod
+
+#identifier -> (module, class). Handler modules pull in their api clients, so they are only imported once a handler is used
+HANDLERS: dict[str, tuple[str, str]] = {
+    'File': ('file', 'FileMetadata'),
+    'Youtube': ('youtube', 'YoutubeMetadata'),
+    'NicoNico': ('niconico', 'NicoNicoMetadata'),
+    'YoutubeMusic': ('youtubemusic', 'YoutubeMusicMetadata'),
+    'AcoustID': ('acoustid_mb', 'AcoustIDMetadata'),
+}
 #TODO: Make this not bad
 class MetadataHandler(ABC):
     @abstractmethod
@@ -24,30 +32,52 @@ class MetadataParser(object):
     def __init__(self, conf: config.Config) -> None:
         self.conf = conf
         self.cache = caching.CacheConnector(self.conf)
-        self.handlers: list[file.MetadataParser] = []
-        self.handler_list = (
-            file.FileMetadata(self.conf),
-            youtube.YoutubeMetadata(self.conf, self.cache),
-            niconico.NicoNicoMetadata(self.conf, self.cache),
-            youtubemusic.YoutubeMusicMetadata(self.conf, self.cache),
-            acoustid_mb.AcoustIDMetadata(self.conf, self.cache)
-        )
+        self.overrides = overrides.Overrides(self.conf)
+        self.handler_instances: dict[str, file.MetadataParser | None] = {}
+        self.handler_lock = threading.Lock()
         self.handlers = self.setup_handler_list(self.conf.metadata.identifiers)
+
+    def get_handler(self, identifier: str) -> file.MetadataParser | None:
+        '''Returns the handler for `identifier`, constructing it on first use'''
+        with self.handler_lock:
+            if identifier not in self.handler_instances:
+                if identifier not in HANDLERS:
+                    logging.warning(f"Unknown metadata handler {identifier}")
+                    self.handler_instances[identifier] = None
+                else:
+                    module, cls = HANDLERS[identifier]
+                    self.handler_instances[identifier] = getattr(importlib.import_module(f".{module}", __name__), cls)(self.conf, self.cache)
+            return self.handler_instances[identifier]
     
     def setup_handler_list(self, handlers: list[str] | tuple[str, ...]) -> list[file.MetadataParser]:
         l = []
         for identifier in handlers:
-            for handler in self.handler_list:
-                if handler.identifier == identifier:
-                    l.append(handler)
+            handler = self.get_handler(identifier)
+            if handler is not None:
+                l.append(handler)
         return l
 
+
+    def prefetch(self, songs: list[songclass.Song]):
+        for handler in self.handlers:
+            valid = [song for song in songs if handler.check_valid(song)]
+            if not valid:
+                continue
+            try:
+                handler.prefetch(valid)
+            except Exception as e:
+                #only an optimization, fetch will retry anything that is missing
+                logging.warning(f"Prefetching for {handler.identifier} failed: {type(e).__name__} {e}")
+                logging.debug("Prefetch traceback", exc_info=True)
+        self.cache.flush()
     
     def parse(self, song: songclass.Song) -> songclass.Song:
-        localhandlers = self.setup_handler_list(overrides.Overrides(self.conf).override('metadata_handlers', song=song, parsers=self.conf.metadata.identifiers)['parsers'])
+        localhandlers = self.setup_handler_list(self.overrides.override('metadata_handlers', song=song, parsers=self.conf.metadata.identifiers)['parsers'])
         for handler in localhandlers:
             if handler.check_valid(song):
-                res = handler.fetch(song)
+                with metrics.span("handler", handler=handler.identifier, result="error") as labels:
+                    res = handler.fetch(song)
+                    labels['result'] = 'miss' if res in (None, False) else 'hit'
                 if res in (None, False):
                     if res is False:
                         logging.warning("Returning `None` from a handler is now preferred to returning `False`.\nThis can be safely ignored by users")
@@ -55,6 +85,7 @@ class MetadataParser(object):
                 song = res
                 break
         #test
-        song = overrides.Overrides(self.conf).override('final_metadata', song=song)['song']
-        song = overrides.Overrides(self.conf).basic_override(song)
+        with metrics.span("overrides"):
+            song = self.overrides.override('final_metadata', song=song)['song']
+            song = self.overrides.basic_override(song)
         return song
\ No newline at end of file
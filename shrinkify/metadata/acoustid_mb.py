@@ -1,33 +1,52 @@
 import io
 import logging
 import pathlib
-import json
-import base64
-import time
+import os
+import concurrent.futures
 from . import caching
 from .. import config
 from . import file
 from .. import songclass
+from ..utils import ratelimit
+from ..utils import filehash
 from PIL import Image
-import requests
 import acoustid
 
+ACOUSTID_LOOKUP = "https://api.acoustid.org/v2/lookup"
+
+def fingerprint(path: str) -> tuple[int, str] | None:
+    '''Runs in a worker process, returns (duration, fingerprint) or None if the file could not be fingerprinted'''
+    try:
+        duration, fp = acoustid.fingerprint_file(path)
+    except acoustid.FingerprintGenerationError as e:
+        logging.warning(f"Could not fingerprint {path}: {e}")
+        return None
+    return int(duration), fp.decode('ascii') if isinstance(fp, bytes) else fp
+
 class AcoustIDMetadata(file.MetadataParser):
     identifier = "AcoustID"
     def __init__(self, conf: config.Config, cache: caching.CacheConnector | None) -> None:
         self.conf = conf
-        self.session = requests.Session()
+        #one musicbrainz budget shared by every worker, see https://musicbrainz.org/doc/MusicBrainz_API/Rate_Limiting
+        self.session = ratelimit.RateLimitedSession({'musicbrainz.org': self.conf.metadata.acoustid.musicbrainz_rate, 'api.acoustid.org': 3}, self.conf.metadata.acoustid.max_retries)
         self.session.headers['User-Agent'] = self.conf.metadata.acoustid.musicbrainz_agent
         self.session.headers['Accept'] = "application/json"
         self.cache = cache.create_simple("acoustidMetadata") if cache is not None else None
         self.cache2 = cache.create_simple("acoustidMetadata2") if cache is not None else None
+        #keyed by file content rather than path so reorganized files don't have to be fingerprinted again
+        self.match_cache = cache.create_simple("acoustidMatch") if cache is not None else None
+        self.fp_cache = cache.create_simple("acoustidFingerprint") if cache is not None else None
         self.rec_cache = cache.create_simple("mbRecording") if cache is not None else None
         self.rel_cache = cache.create_simple("mbRelease") if cache is not None else None
-        if self.cache and self.rec_cache and self.rel_cache and self.cache2:
-            self.cache.load_generic_schema("relativePath", "data")
-            self.cache2.load_generic_schema("relativePath", "data")
-            self.rec_cache.load_generic_schema("id", "data")
-            self.rel_cache.load_generic_schema("id", "data")
+        if self.cache and self.rec_cache and self.rel_cache and self.cache2 and self.match_cache and self.fp_cache:
+            self.cache.load_payload_schema("relativePath", "data", legacy_format='base64json')
+            self.cache2.load_payload_schema("relativePath", "data", legacy_format='base64json')
+            self.match_cache.load_payload_schema("digest", "data")
+            self.fp_cache.load_payload_schema("digest", "data")
+            self.rec_cache.load_payload_schema("id", "data", legacy_format='base64json')
+            self.rel_cache.load_payload_schema("id", "data", legacy_format='base64json')
+        self.thumbnails = cache.thumbnail_store() if cache is not None else caching.ThumbnailStore(self.conf)
+        self.digests = cache.digest_index() if cache is not None else filehash.DigestIndex()
         #self.musicbrainz_cache = cache.create_simple("musicbrainzMetadata") if cache is not None else None
 
     def check_valid(self, song: songclass.Song) -> bool:
@@ -38,22 +57,93 @@ class AcoustIDMetadata(file.MetadataParser):
         else:
             return True
     
-    @staticmethod
-    def uncache(data):
-        return json.loads(base64.b64decode(data))
-    
-    @staticmethod
-    def cachify(data: object) -> bytes:
-        return base64.b64encode(json.dumps(data).encode('utf8'))
-            
+    def prefetch(self, songs: list[songclass.Song]) -> None:
+        '''
+        Fingerprints every song without a cached AcoustID response across a process pool,
+        then looks the fingerprints up several per request.
+        Only runs when enabled, as it can't tell which songs an earlier handler will claim and
+        has to finish before the first song is converted.
+        '''
+        if not self.conf.metadata.acoustid.prefetch or not self.match_cache or not self.fp_cache:
+            return
+        if not self.match_cache.use_cache:
+            #the results could never be read back, fetch would fingerprint and look up everything again
+            return
+        paths: dict[str, pathlib.Path] = {}
+        for song in songs:
+            try:
+                paths.setdefault(self.digests.digest(song.path), song.path.expanduser())
+            except OSError:
+                continue
+        pending = [d for d in self.match_cache.missing('digest', paths.keys()) if self.legacy_match(paths[d], d) is None]
+        if not pending:
+            return
+        fingerprints: list[tuple[str, tuple[int, str]]] = []
+        unprinted = []
+        for digest in pending:
+            fp = self.fp_cache.get(digest=digest)
+            if fp is not None:
+                fingerprints.append((digest, tuple(fp))) #type:ignore
+            else:
+                unprinted.append(digest)
+        if unprinted:
+            jobs = self.conf.metadata.acoustid.fingerprint_jobs or os.cpu_count() or 1
+            logging.info(f"Fingerprinting {len(unprinted)} files using {jobs} processes")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+                for digest, fp in zip(unprinted, pool.map(fingerprint, (str(paths[d]) for d in unprinted), chunksize=4)):
+                    if fp is not None:
+                        self.fp_cache.put(fp, digest=digest)
+                        fingerprints.append((digest, fp))
+        batch_size = max(1, self.conf.metadata.acoustid.lookup_batch_size)
+        for i in range(0, len(fingerprints), batch_size):
+            batch = fingerprints[i:i+batch_size]
+            data: dict[str, str | int] = {'format': 'json', 'client': self.conf.metadata.acoustid.api_key, 'meta': 'recordings sources'} #type:ignore
+            for n, (_, (duration, fp)) in enumerate(batch):
+                data[f'duration.{n}'] = duration
+                data[f'fingerprint.{n}'] = fp
+            resp_data = self.session.post(ACOUSTID_LOOKUP, data=data).json()
+            if resp_data.get('status') != 'ok':
+                logging.warning(f"Batched AcoustID lookup failed: {resp_data.get('error', {}).get('message', resp_data)}")
+                return
+            for result in resp_data['fingerprints']:
+                #stored in the same shape as a single lookup so fetch reads it unchanged
+                self.match_cache.put({'status': 'ok', 'results': result['results']}, digest=batch[int(result['index'])][0])
+
+    def legacy_match(self, path: pathlib.Path, digest: str) -> dict | None:
+        '''Responses cached by path before they were keyed by content are moved over on first use'''
+        if not self.cache2 or not self.match_cache:
+            return None
+        try:
+            relative_path = str(path.relative_to(self.conf.general.root))
+        except ValueError:
+            return None
+        data = self.cache2.get(relativePath=relative_path)
+        if data is not None:
+            self.match_cache.put(data, digest=digest)
+        return data
+
+    def get_match(self, song: songclass.Song) -> dict:
+        digest = self.digests.digest(song.path)
+        data = self.match_cache.get(digest=digest) if self.match_cache else None
+        if data is None:
+            data = self.legacy_match(song.path, digest)
+        if data is None:
+            fp = self.fp_cache.get(digest=digest) if self.fp_cache else None
+            if fp is None:
+                fp = fingerprint(str(song.path.expanduser()))
+                if fp is None:
+                    raise RuntimeError(f"Could not fingerprint {song.path}")
+                if self.fp_cache:
+                    self.fp_cache.put(fp, digest=digest)
+            duration, fp_data = fp
+            data = acoustid.lookup(self.conf.metadata.acoustid.api_key, fp_data, duration, meta=['recordings', 'sources'])
+            if self.match_cache and data.get('status') == 'ok':
+                self.match_cache.put(data, digest=digest)
+        return data #type:ignore
+
     def fetch(self, song: songclass.Song) -> bool | songclass.Song:
         #get musicbrainz id
-        if self.cache2 and self.cache2.contains(relativePath=str(song.path.relative_to(self.conf.general.root))):
-            acoustid_rresp: dict = self.uncache(self.cache2.fetch_one(relativePath=str(song.path.relative_to(self.conf.general.root)))['data'])
-        else:
-            acoustid_rresp: dict = acoustid.match(self.conf.metadata.acoustid.api_key, str(song.path.expanduser()), parse=False, meta=['recordings', 'sources']) #type:ignore
-            if self.cache2:
-                self.cache2.insert({'relativePath': str(song.path.relative_to(self.conf.general.root)), 'data': self.cachify(acoustid_rresp)}, key='relativePath')
+        acoustid_rresp = self.get_match(song)
         #get actual metadata
         full_list = []
         for result in acoustid_rresp['results']:
@@ -69,12 +159,9 @@ class AcoustIDMetadata(file.MetadataParser):
             if match[0][0] < self.conf.metadata.acoustid.score_threshold:
                 return False
             
-            if self.rec_cache and self.rec_cache.contains(id=match[1]):
-                recording = self.uncache(self.rec_cache.fetch_one(id=match[1])['data'])
-            else: #not cached/no cache
-                time.sleep(1)
+            recording = self.rec_cache.get(id=match[1]) if self.rec_cache else None
+            if recording is None: #not cached/no cache
                 rec_resp = self.session.get(f"https://musicbrainz.org/ws/2/recording/{match[1]}", params={'inc': 'releases+work-rels+artist-credits'})
-                time.sleep(1)
                 if rec_resp.status_code != 200:
                     continue
                 recording = rec_resp.json()
@@ -82,23 +169,21 @@ class AcoustIDMetadata(file.MetadataParser):
                 if 'releases' not in recording: #strange off-case
                     continue
                 if self.rec_cache:
-                    self.rec_cache.insert({'id': match[1], 'data': self.cachify(recording)}, key='id')
+                    self.rec_cache.put(recording, id=match[1])
             related_mode = False
             for rec_release in recording['releases']:
-                if self.rel_cache and self.rel_cache.contains(id=rec_release['id']):
-                    release = self.uncache(self.rel_cache.fetch_one(id=rec_release['id'])['data'])
+                release = self.rel_cache.get(id=rec_release['id']) if self.rel_cache else None
+                if release is not None:
                     break
                 else:
-                    time.sleep(1)
                     rel_resp = self.session.get(f"https://musicbrainz.org/ws/2/release/{rec_release['id']}", params={'inc': 'artists+collections+labels+recordings+release-groups'})
-                    time.sleep(1)
                     if rel_resp.status_code != 200:
                         continue
                     release = rel_resp.json()
                     if ('cover-art-archive' not in release or not release['cover-art-archive']['front']) and not self.conf.metadata.acoustid.allow_missing_image:
                         continue
                     if self.rel_cache:
-                        self.rel_cache.insert({'id': rec_release['id'], 'data': self.cachify(release)}, key='id')
+                        self.rel_cache.put(release, id=rec_release['id'])
                     break
             else:
                 #check related works
@@ -111,23 +196,19 @@ class AcoustIDMetadata(file.MetadataParser):
                 else:
                     continue
                 if relation is None: continue
-                time.sleep(1)
                 related_works = self.session.get(f"https://musicbrainz.org/ws/2/work/{relation['work']['id']}", params={'inc': 'aliases+recording-rels'}).json()
-                time.sleep(1)
                 for related_recording in related_works['relations']:
                     if related_recording['target-type'] != 'recording':
                         continue
                     related_recording_data = self.session.get(f"https://musicbrainz.org/ws/2/recording/{related_recording['recording']['id']}", params={'inc': 'aliases+artist-credits+releases'}).json()
-                    time.sleep(1)
                     for release_raw in related_recording_data['releases']:
                         release = self.session.get(f"https://musicbrainz.org/ws/2/release/{release_raw['id']}", params={'inc': 'artists+collections+labels+recordings+release-groups'}).json()
-                        time.sleep(1)
                         logging.debug(release)
                         if ('cover-art-archive' not in release or not release['cover-art-archive']['front']) and not self.conf.metadata.acoustid.allow_missing_image:
                             logging.debug("no cover found")
                             continue
                         if self.rel_cache:
-                            self.rel_cache.insert({'id': related_recording['recording']['id'], 'data': self.cachify(release)}, key='id')
+                            self.rel_cache.put(release, id=related_recording['recording']['id'])
                         break
                     else:
                         continue
@@ -139,19 +220,17 @@ class AcoustIDMetadata(file.MetadataParser):
             return False
 
         #get cover art
-        cache_dir = pathlib.Path(self.conf.general.cache_dir)
         if self.conf.metadata.acoustid.allow_missing_image and not release['cover-art-archive']['front']:
             image = Image.new('RGBA', (1000,1000), 'black')
-        elif cache_dir.is_dir() and pathlib.Path(cache_dir, f"{release['id']}.png").exists():
-            image = Image.open(pathlib.Path(cache_dir, f"{release['id']}.png"))
         else:
-            resp = self.session.get(f"https://coverartarchive.org/release/{release['id']}/front")
-            if resp.status_code != 200:
-                return False
-            raw_data = resp.content
+            raw_data = self.thumbnails.get(release['id'])
+            if raw_data is None:
+                resp = self.session.get(f"https://coverartarchive.org/release/{release['id']}/front")
+                if resp.status_code != 200:
+                    return False
+                raw_data = resp.content
+                self.thumbnails.put(release['id'], raw_data, ".png")
             image = Image.open(io.BytesIO(raw_data))
-            if cache_dir.is_dir():
-                pathlib.Path(cache_dir, release['id']+".png").write_bytes(raw_data)
         
         song['title'] = recording['title']
         song['artist'] = list(set(a['name'] for a in release['artist-credit']).union(set(a['name'] for a in recording['artist-credit'])))
@@ -1,31 +1,217 @@
+import atexit
+import base64
+import collections
+import hashlib
+import json
+import logging
 import os
 import sqlite3
+import threading
+import time
 import typing
 import pathlib
+import zlib
 from .. import config
+from .. import metrics
+from ..utils import atomicfile
+from ..utils import filehash
+
+MIGRATION_CHUNK = 1000 #rows converted per transaction when upgrading a table
+
+def encode_payload(data: typing.Any) -> bytes:
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf8'))
+
+def decode_payload(raw: bytes) -> typing.Any:
+    return json.loads(zlib.decompress(raw))
+
+#how payloads were stored before tables were moved to compressed blobs
+LEGACY_DECODERS: dict[str, typing.Callable[[typing.Any], typing.Any]] = {
+    'base64json': lambda raw: json.loads(base64.b64decode(raw)),
+    'json': lambda raw: json.loads(raw),
+}
+
+LIFECYCLE_COLUMNS = {
+    'created': 'REAL NOT NULL DEFAULT 0',
+    'last_access': 'REAL NOT NULL DEFAULT 0',
+}
+
+class MemoCache(object):
+    """
+    Bounded in-process LRU of decoded cache entries, kept in front of the SQLite tables
+    so objects that are looked up over and over in a run are only decoded once.
+    Entries are shared between callers and must be treated as read-only.
+    """
+    def __init__(self, name: str, size: int) -> None:
+        self.name = name
+        self.size = size
+        self.entries: collections.OrderedDict[typing.Hashable, typing.Any] = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: typing.Hashable) -> typing.Any:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                data = self.entries[key]
+            else:
+                data = None
+        metrics.count("memo_lookups", cache=self.name, result="miss" if data is None else "hit")
+        return data
+
+    def put(self, key: typing.Hashable, value: typing.Any):
+        if self.size <= 0 or value is None:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def memoized(self, key: typing.Hashable, load: typing.Callable[[], typing.Any]) -> typing.Any:
+        '''Returns the memoized value for `key`, calling `load` to produce it on a miss'''
+        data = self.get(key)
+        if data is None:
+            data = load()
+            self.put(key, data)
+        return data
 
 class SimpleConnection(object):
-    def __init__(self, table: str, cursor: sqlite3.Cursor, use_cache=True) -> None:
+    def __init__(self, table: str, cursor: sqlite3.Cursor, use_cache=True, lock: typing.Optional[typing.ContextManager] = None, connector: typing.Optional['CacheConnector'] = None) -> None:
         self.table = table
         self.cursor = cursor
         self.cursor.row_factory = sqlite3.Row # type: ignore
         self.use_cache = use_cache
+        #the connection is shared between conversion workers, so every statement goes through this lock
+        self.lock = lock if lock is not None else threading.RLock()
+        self.connector = connector
+        self.key_names: tuple[str, ...] = tuple()
+        self.data_name: str | None = None
+
+    def _written(self):
+        #commits are batched by the connector when there is one
+        if self.connector is not None:
+            self.connector.note_write()
+        else:
+            self.cursor.connection.commit()
                 
     def load_schema(self, schema: str):
-        self.cursor.executescript(schema)
-        self.cursor.connection.commit()
+        with self.lock:
+            self.cursor.executescript(schema)
+            self.cursor.connection.commit()
         
     def load_generic_schema(self, keyName: str, dataName: str):
-        self.cursor.executescript(f"""
-            CREATE TABLE IF NOT EXISTS {self.table} (
-                {keyName} STRING PRIMARY KEY NOT NULL,
-                {dataName} STRING NOT NULL
-            );""")
-        self.cursor.connection.commit()
-        
+        with self.lock:
+            self.cursor.executescript(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    {keyName} STRING PRIMARY KEY NOT NULL,
+                    {dataName} STRING NOT NULL
+                );""")
+            self.cursor.connection.commit()
+
+    def ensure_columns(self, columns: dict[str, str]) -> list[str]:
+        '''Adds columns that tables created by older versions lack, returns the ones that were added'''
+        with self.lock:
+            existing = {row['name'] for row in self.cursor.execute(f"PRAGMA table_info({self.table})")}
+            added = [name for name in columns if name not in existing]
+            for name in added:
+                self.cursor.execute(f"ALTER TABLE {self.table} ADD COLUMN {name} {columns[name]}")
+            self.cursor.connection.commit()
+            return added
+
+    def load_payload_schema(self, keyNames: str | tuple[str, ...], dataName: str, legacy_format: str | None = None):
+        '''
+        Sets up a table for `get`/`put`, which store their payload as compressed JSON in a BLOB column.
+        Tables written by older versions in `legacy_format` (see LEGACY_DECODERS) are converted in place.
+        '''
+        self.key_names = (keyNames,) if isinstance(keyNames, str) else tuple(keyNames)
+        self.data_name = dataName
+        with self.lock:
+            self.cursor.executescript(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    {', '.join(f'{k} STRING NOT NULL' for k in self.key_names)},
+                    {dataName} BLOB NOT NULL,
+                    {', '.join(f'{k} {v}' for k, v in LIFECYCLE_COLUMNS.items())},
+                    PRIMARY KEY ({', '.join(self.key_names)})
+                );
+                CREATE TABLE IF NOT EXISTS shrinkifyCacheFormat (
+                    table_name STRING PRIMARY KEY NOT NULL,
+                    format STRING NOT NULL
+                );""")
+            row = self.cursor.execute("SELECT format FROM shrinkifyCacheFormat WHERE table_name = ?", (self.table,)).fetchone()
+            if row is None or row['format'] != 'zjson':
+                self._migrate_payloads(legacy_format if row is None else row['format'])
+                self.cursor.execute("INSERT OR REPLACE INTO shrinkifyCacheFormat VALUES (?, 'zjson')", (self.table,))
+            if self.ensure_columns(LIFECYCLE_COLUMNS):
+                #the age of older rows is unknown, so count it from now rather than expiring everything at once
+                self.cursor.execute(f"UPDATE {self.table} SET created = :now, last_access = :now", {'now': time.time()})
+            self.cursor.connection.commit()
+
+    def _migrate_payloads(self, legacy_format: str | None):
+        #"format@rowid" marks a conversion interrupted after rowid
+        legacy_format, _, done = (legacy_format or '').partition('@')
+        last = int(done or 0)
+        remaining = self.cursor.execute(f"SELECT COUNT(*) FROM {self.table} WHERE rowid > ?", (last,)).fetchone()[0]
+        if not remaining:
+            return
+        decoder = LEGACY_DECODERS.get(legacy_format) if legacy_format else None
+        logging.info(f"Converting {remaining} rows of {self.table} to compressed payloads")
+        while True:
+            #in rowid order a chunk at a time, so a large table is neither loaded at once nor converted in one transaction
+            rows = self.cursor.execute(f"SELECT rowid, {self.data_name} FROM {self.table} WHERE rowid > ? ORDER BY rowid LIMIT ?", (last, MIGRATION_CHUNK)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                try:
+                    if decoder is None:
+                        raise ValueError(f"unknown format {legacy_format}")
+                    payload = encode_payload(decoder(row[1]))
+                except (ValueError, TypeError, zlib.error) as e:
+                    logging.warning(f"Dropping unreadable {self.table} row {row[0]}: {e}")
+                    self.cursor.execute(f"DELETE FROM {self.table} WHERE rowid = ?", (row[0],))
+                    continue
+                self.cursor.execute(f"UPDATE {self.table} SET {self.data_name} = ? WHERE rowid = ?", (payload, row[0]))
+            last = rows[-1][0]
+            #progress is committed with each chunk, so an interrupted run resumes instead of decoding converted rows again
+            self.cursor.execute("INSERT OR REPLACE INTO shrinkifyCacheFormat VALUES (?, ?)", (self.table, f"{legacy_format}@{last}"))
+            self.cursor.connection.commit()
+
+    def get(self, **kwargs) -> typing.Any:
+        '''
+        Returns the decoded payload stored under the given key,
+        or None on a miss, if the entry is older than the table's TTL or if cache use is disabled
+        '''
+        if not self.use_cache:
+            return None
+        ttl = self.connector.ttl(self.table) if self.connector is not None else None
+        with self.lock:
+            row = self.cursor.execute(f"SELECT {self.data_name}, created FROM {self.table} WHERE {' AND '.join(f'{key} = :{key}' for key in kwargs.keys())}", kwargs).fetchone()
+            if row is not None and ttl and row[1] < time.time() - ttl:
+                row = None #expired, `prune` deletes it
+            if self.connector is not None:
+                self.connector.record_access(self.table, kwargs, row is not None)
+            metrics.count("cache_lookups", table=self.table, result="miss" if row is None else "hit")
+            if row is None:
+                return None
+        try:
+            return decode_payload(row[0])
+        except (ValueError, zlib.error):
+            logging.warning(f"Ignoring corrupt {self.table} entry for {kwargs}")
+            return None
+
+    def put(self, data: typing.Any, **kwargs) -> None:
+        '''Stores `data` under the given key, replacing what was there'''
+        values = dict(kwargs)
+        values[typing.cast(str, self.data_name)] = encode_payload(data)
+        values['created'] = values['last_access'] = time.time()
+        with self.lock:
+            self.cursor.execute(f"INSERT OR REPLACE INTO {self.table} ({', '.join(values.keys())}) VALUES ({', '.join(f':{k}' for k in values.keys())})", values)
+            self._written()
             
     def insert(self, data: list[typing.Any] | dict[str, typing.Any], key: typing.Optional[str | tuple] = None) -> None:
         '''Will also update if already exists'''
+        with self.lock:
+            self._insert(data, key)
+
+    def _insert(self, data: list[typing.Any] | dict[str, typing.Any], key: typing.Optional[str | tuple] = None) -> None:
         if isinstance(data, list):
             try:
                 self.cursor.execute(f"INSERT INTO {self.table} VALUES ({', '.join('?' for _ in data)})", *data)
@@ -39,7 +225,7 @@ class SimpleConnection(object):
                 if key is None:
                     raise RuntimeError("Tried to update table but key is not set")
                 self.cursor.execute(f"UPDATE {self.table} SET {', '.join(f'{k} = :{k}' for k in ks)} WHERE {' AND '.join(f'{k} = :{k}' for k in key) if not isinstance(key, str) else f'{key} = :{key}'}", data)
-        self.cursor.connection.commit()
+        self._written()
     
     def contains(self, **kwargs) -> bool:
         #if cache use is disabled, return false no matter what
@@ -49,22 +235,334 @@ class SimpleConnection(object):
             return False 
         
     def fetch(self, **kwargs) -> sqlite3.Cursor:
+        if not kwargs: #whole table
+            return self.cursor.execute(f"SELECT * FROM {self.table}")
         return self.cursor.execute(f"SELECT * FROM {self.table} WHERE {' AND '.join(f'{key} = :{key}' for key in kwargs.keys())}", kwargs)
+
+    def missing(self, key: str, values: typing.Iterable[str]) -> list[str]:
+        '''Returns the values of the single column `key` that have no row yet, in their original order'''
+        values = list(dict.fromkeys(values))
+        if not self.use_cache:
+            return values
+        present = set()
+        with self.lock:
+            #stay under sqlite's bound parameter limit
+            for i in range(0, len(values), 500):
+                chunk = values[i:i+500]
+                present.update(row[0] for row in self.cursor.execute(f"SELECT {key} FROM {self.table} WHERE {key} IN ({', '.join('?' for _ in chunk)})", chunk))
+        return [v for v in values if v not in present]
+
+    def delete(self, **kwargs) -> None:
+        with self.lock:
+            self.cursor.execute(f"DELETE FROM {self.table} WHERE {' AND '.join(f'{key} = :{key}' for key in kwargs.keys())}", kwargs)
+            self._written()
+
+    def exists(self) -> bool:
+        '''Whether the table has been created yet'''
+        with self.lock:
+            return self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (self.table,)).fetchone() is not None
     
     def fetch_multiple(self, **kwargs) -> list[sqlite3.Row]:
-        return self.fetch(**kwargs).fetchall()
+        with self.lock:
+            return self.fetch(**kwargs).fetchall()
     
     def fetch_one(self, **kwargs) -> sqlite3.Row:
-        return self.fetch(**kwargs).fetchone()
+        with self.lock:
+            return self.fetch(**kwargs).fetchone()
+
+class ThumbnailStore(object):
+    """
+    Images (thumbnails, channel icons, cover art) stored under `cache_dir/thumbnails` in sharded subdirectories.
+    An index from key to file makes lookups O(1) instead of globbing a directory with tens of thousands of files,
+    and writes go through a temp file so concurrent writers never leave half-written images behind.
+    """
+    def __init__(self, conf: config.Config, index: SimpleConnection | None = None) -> None:
+        self.conf = conf
+        self.cache_dir = pathlib.Path(self.conf.general.cache_dir)
+        self.root = pathlib.Path(self.cache_dir, "thumbnails")
+        self.index = index
+        self.lock = threading.RLock()
+        self._entries: dict[str, str] | None = None
+
+    @property
+    def entries(self) -> dict[str, str]:
+        with self.lock:
+            if self._entries is None:
+                self._entries = {}
+                if self.index is not None:
+                    created = not self.index.exists()
+                    self.index.load_schema(f"""CREATE TABLE IF NOT EXISTS {self.index.table}(key STRING PRIMARY KEY NOT NULL, path STRING NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL DEFAULT 0);""")
+                    self.index.ensure_columns({'last_access': LIFECYCLE_COLUMNS['last_access']})
+                    if created:
+                        self.adopt_legacy()
+                    self._entries.update((row['key'], row['path']) for row in self.index.fetch_multiple())
+            return self._entries
+
+    def adopt_legacy(self):
+        '''Indexes images from before the store existed, which were saved directly in cache_dir as <key>.<ext>'''
+        assert self.index is not None
+        if not self.cache_dir.is_dir():
+            return
+        count = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                stem, suffix = os.path.splitext(entry.name)
+                if suffix.lower() not in ('.jpg', '.jpeg', '.png', '.webp'):
+                    continue
+                with self.index.lock:
+                    self.index.cursor.execute(f"INSERT OR IGNORE INTO {self.index.table} (key, path, size, last_access) VALUES (?, ?, ?, ?)", (stem, entry.name, entry.stat().st_size, time.time()))
+                count += 1
+        with self.index.lock:
+            self.index.cursor.connection.commit()
+        if count:
+            logging.info(f"Indexed {count} existing images in {self.cache_dir}")
+
+    def reload(self):
+        with self.lock:
+            self._entries = None
+
+    def path_for(self, key: str, suffix: str) -> pathlib.Path:
+        shard = hashlib.sha1(key.encode('utf8')).hexdigest()[:2]
+        return pathlib.Path(self.root, shard, key+suffix)
+
+    def get(self, key: str) -> bytes | None:
+        relative = self.entries.get(key)
+        if relative is None and self.index is None:
+            #without an index the sharded path can still be probed directly
+            for suffix in ('.jpg', '.png'):
+                if self.path_for(key, suffix).is_file():
+                    relative = str(self.path_for(key, suffix).relative_to(self.cache_dir))
+                    break
+        if relative is None:
+            if self.index is not None and self.index.connector is not None:
+                self.index.connector.record_access(self.index.table, {'key': key}, False)
+            return None
+        try:
+            data = pathlib.Path(self.cache_dir, relative).read_bytes()
+            if self.index is not None and self.index.connector is not None:
+                self.index.connector.record_access(self.index.table, {'key': key}, True)
+            return data
+        except FileNotFoundError:
+            #removed behind our back
+            with self.lock:
+                self.entries.pop(key, None)
+            if self.index is not None:
+                self.index.delete(key=key)
+            return None
+
+    def put(self, key: str, data: bytes, suffix: str = ".jpg"):
+        path = self.path_for(key, suffix)
+        try:
+            atomicfile.write_atomic(path, data)
+        except OSError as e:
+            logging.warning(f"Could not store {key} in the thumbnail cache: {e}")
+            return
+        relative = str(path.relative_to(self.cache_dir))
+        with self.lock:
+            self.entries[key] = relative
+        if self.index is not None:
+            self.index.insert({'key': key, 'path': relative, 'size': len(data), 'last_access': time.time()}, key='key')
 
 class CacheConnector(object):
     def __init__(self, conf: config.Config):
         self.conf = conf
         pathlib.Path(self.conf.general.cache_file).parent.mkdir(parents=True, exist_ok=True)
-        self.db = sqlite3.connect(self.conf.general.cache_file)
+        self.db = sqlite3.connect(self.conf.general.cache_file, check_same_thread=False, timeout=self.conf.general.cache_busy_timeout/1000)
+        self.db.execute(f"PRAGMA busy_timeout = {int(self.conf.general.cache_busy_timeout)}")
+        if self.conf.general.cache_journal_mode:
+            self.db.execute(f"PRAGMA journal_mode = {self.conf.general.cache_journal_mode}")
+            if self.conf.general.cache_journal_mode.lower() == 'wal':
+                self.db.execute("PRAGMA synchronous = NORMAL") #safe with WAL, and avoids an fsync per commit
+        self.lock = threading.RLock()
+        self.pending_writes = 0
+        self.commit_timer: threading.Timer | None = None
+        self._thumbnails: ThumbnailStore | None = None
+        self._digests: filehash.DigestIndex | None = None
+        #access times and hit/miss counts are buffered and written on flush
+        self.accessed: dict[str, dict[tuple[tuple[str, typing.Any], ...], float]] = {}
+        self.counters: dict[str, list[int]] = {}
+        with self.lock:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS shrinkifyCacheStats (
+                    table_name STRING PRIMARY KEY NOT NULL,
+                    hits INTEGER NOT NULL,
+                    misses INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS shrinkifyCacheFormat (
+                    table_name STRING PRIMARY KEY NOT NULL,
+                    format STRING NOT NULL
+                );""")
+            self.db.commit()
+        atexit.register(self.flush)
     
     def get_cursor(self):
         return self.db.cursor()
     
     def create_simple(self, table: str) -> SimpleConnection:
-        return SimpleConnection(table, self.get_cursor(), self.conf.general.use_cache)
\ No newline at end of file
+        return SimpleConnection(table, self.get_cursor(), self.conf.general.use_cache, self.lock, self)
+
+    def note_write(self):
+        '''
+        Commits every `cache_commit_interval` writes instead of after each one,
+        or `cache_commit_delay` seconds after the oldest uncommitted write, whichever comes first
+        '''
+        with self.lock:
+            self.pending_writes += 1
+            if self.pending_writes >= max(1, self.conf.general.cache_commit_interval):
+                self.flush()
+            elif self.commit_timer is None:
+                self.commit_timer = threading.Timer(self.conf.general.cache_commit_delay, self._timed_flush)
+                self.commit_timer.daemon = True
+                self.commit_timer.start()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except sqlite3.OperationalError as e:
+            #another process held the lock past the busy timeout, the next write or flush tries again
+            logging.warning(f"Could not commit cache writes: {e}")
+
+    def ttl(self, table: str) -> float | None:
+        return self.conf.general.cache_ttl.get(table)
+
+    def record_access(self, table: str, key: dict[str, typing.Any], hit: bool):
+        with self.lock:
+            counter = self.counters.setdefault(table, [0, 0])
+            counter[0 if hit else 1] += 1
+            if hit:
+                self.accessed.setdefault(table, {})[tuple(key.items())] = time.time()
+
+    def flush(self):
+        with self.lock:
+            self.pending_writes = 0
+            if self.commit_timer is not None:
+                self.commit_timer.cancel()
+                self.commit_timer = None
+            try:
+                for table, accessed in self.accessed.items():
+                    for key, when in accessed.items():
+                        self.db.execute(f"UPDATE {table} SET last_access = ? WHERE {' AND '.join(f'{k} = ?' for k, _ in key)}", (when, *(v for _, v in key)))
+                for table, (hits, misses) in self.counters.items():
+                    self.db.execute("""INSERT INTO shrinkifyCacheStats VALUES (?, ?, ?)
+                        ON CONFLICT(table_name) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses""", (table, hits, misses))
+                self.accessed.clear()
+                self.counters.clear()
+                self.db.commit()
+            except sqlite3.ProgrammingError: #already closed
+                pass
+
+    def payload_tables(self) -> list[tuple[str, str]]:
+        '''(table, payload column) for every table managed through `load_payload_schema`'''
+        tables = []
+        with self.lock:
+            for row in self.db.execute("SELECT table_name FROM shrinkifyCacheFormat").fetchall():
+                columns = self.db.execute(f"PRAGMA table_info({row[0]})").fetchall()
+                data = [c[1] for c in columns if not c[5] and c[1] not in LIFECYCLE_COLUMNS]
+                if data:
+                    tables.append((row[0], data[0]))
+        return tables
+
+    def image_files(self) -> list[tuple[float, int, pathlib.Path, str | None]]:
+        '''(last access, size, path, thumbnail key) for every cached image in cache_dir'''
+        images = []
+        store = self.thumbnail_store()
+        store.entries #make sure the index exists
+        with self.lock:
+            for key, path, size, last_access in self.db.execute("SELECT key, path, size, last_access FROM thumbnailIndex").fetchall():
+                images.append((last_access, size, pathlib.Path(store.cache_dir, path), key))
+        covers = pathlib.Path(self.conf.general.cache_dir, "covers")
+        if covers.is_dir():
+            for cover in covers.rglob("*"):
+                if cover.is_file():
+                    stat = cover.stat()
+                    images.append((stat.st_mtime, stat.st_size, cover, None))
+        return images
+
+    def stats(self) -> list[dict[str, typing.Any]]:
+        self.flush()
+        result = []
+        with self.lock:
+            counters = {row[0]: (row[1], row[2]) for row in self.db.execute("SELECT table_name, hits, misses FROM shrinkifyCacheStats")}
+            for table, data in self.payload_tables():
+                rows, size = self.db.execute(f"SELECT count(*), coalesce(sum(length({data})), 0) FROM {table}").fetchone()
+                hits, misses = counters.get(table, (0, 0))
+                result.append({'table': table, 'rows': rows, 'bytes': size, 'hits': hits, 'misses': misses})
+        images = self.image_files()
+        hits, misses = counters.get("thumbnailIndex", (0, 0))
+        result.append({'table': 'images', 'rows': len(images), 'bytes': sum(i[1] for i in images), 'hits': hits, 'misses': misses})
+        return result
+
+    def prune(self) -> dict[str, int]:
+        '''
+        Deletes entries older than their table's TTL, then evicts the least recently used entries
+        (rows and images alike) until the cache fits in `general.cache_max_size` megabytes.
+        Returns the number of entries removed per table.
+        '''
+        self.flush()
+        removed: dict[str, int] = {}
+        now = time.time()
+        with self.lock:
+            for table, _ in self.payload_tables():
+                ttl = self.ttl(table)
+                if ttl:
+                    removed[table] = self.db.execute(f"DELETE FROM {table} WHERE created < ?", (now - ttl,)).rowcount
+            self.db.commit()
+        if self.conf.general.cache_max_size:
+            self.evict(self.conf.general.cache_max_size*1024*1024, removed)
+        return {k: v for k, v in removed.items() if v}
+
+    def evict(self, budget: int, removed: dict[str, int]):
+        candidates: list[tuple[float, int, str, typing.Any]] = []
+        with self.lock:
+            for table, data in self.payload_tables():
+                candidates.extend((r[0], r[1], table, r[2]) for r in self.db.execute(f"SELECT last_access, length({data}), rowid FROM {table}"))
+        candidates.extend((last_access, size, 'images', (path, key)) for last_access, size, path, key in self.image_files())
+        total = sum(c[1] for c in candidates)
+        if total <= budget:
+            return
+        candidates.sort(key=lambda c: c[0])
+        with self.lock:
+            for _, size, table, ident in candidates:
+                if total <= budget:
+                    break
+                if table == 'images':
+                    path, key = ident
+                    path.unlink(missing_ok=True)
+                    if key is not None:
+                        self.db.execute("DELETE FROM thumbnailIndex WHERE key = ?", (key,))
+                else:
+                    self.db.execute(f"DELETE FROM {table} WHERE rowid = ?", (ident,))
+                removed[table] = removed.get(table, 0) + 1
+                total -= size
+            self.db.commit()
+            if self._thumbnails is not None:
+                self._thumbnails.reload()
+
+    def vacuum(self) -> tuple[int, int]:
+        '''Compacts the database file, returns its size before and after'''
+        self.flush()
+        cache_file = pathlib.Path(self.conf.general.cache_file)
+        def size() -> int:
+            #in WAL mode recent writes live in the -wal file next to the database
+            return sum(f.stat().st_size for f in (cache_file, cache_file.with_name(cache_file.name+"-wal")) if f.is_file())
+        before = size()
+        with self.lock:
+            self.db.execute("VACUUM")
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return before, size()
+
+    def thumbnail_store(self) -> ThumbnailStore:
+        '''The shared image store, indexed in this database'''
+        with self.lock:
+            if self._thumbnails is None:
+                self._thumbnails = ThumbnailStore(self.conf, self.create_simple("thumbnailIndex"))
+            return self._thumbnails
+
+    def digest_index(self) -> filehash.DigestIndex:
+        '''The shared path -> content digest index, so caches keyed by content survive files being moved'''
+        with self.lock:
+            if self._digests is None:
+                self._digests = filehash.DigestIndex(self.create_simple("fileDigestIndex"))
+            return self._digests
@@ -1,11 +1,57 @@
+import base64
 import io
+import logging
 import pathlib
 import subprocess
 import json
+import typing
+import mutagen
+import mutagen.flac
+import mutagen.id3
+import mutagen.mp4
+import mutagen._vorbis
 from abc import ABC, abstractmethod
 from PIL import Image
 from .. import config
 from .. import songclass
+from .. import metrics
+
+IGNORED_TAGS = ("compatible_brands", "encoder", "ENCODER", "encoded_by", "major_brand", "minor_brand", "minor_version")
+
+#mutagen tag names to the names ffprobe reports
+ID3_TAGS = {
+    'TIT2': 'title',
+    'TPE1': 'artist',
+    'TALB': 'album',
+    'TPE2': 'album_artist',
+    'TDRC': 'date',
+    'TRCK': 'track',
+    'TPOS': 'disc',
+    'TCON': 'genre',
+    'TCOM': 'composer',
+    'TPUB': 'publisher',
+    'TCOP': 'copyright',
+    'TSSE': 'encoder',
+    'TENC': 'encoded_by',
+}
+MP4_TAGS = {
+    '\xa9nam': 'title',
+    '\xa9ART': 'artist',
+    '\xa9alb': 'album',
+    'aART': 'album_artist',
+    '\xa9day': 'date',
+    '\xa9gen': 'genre',
+    '\xa9cmt': 'comment',
+    '\xa9wrt': 'composer',
+    '\xa9too': 'encoder',
+    'cprt': 'copyright',
+}
+VORBIS_TAGS = {
+    'albumartist': 'album_artist',
+    'tracknumber': 'track',
+    'discnumber': 'disc',
+    'description': 'comment',
+}
 
 class MetadataParser(ABC):
     identifier = "DEFAULT"
@@ -21,6 +67,13 @@ class MetadataParser(ABC):
     def fetch(self, song: songclass.Song) -> None | songclass.Song:
         pass
 
+    def prefetch(self, songs: list[songclass.Song]) -> None:
+        '''
+        Optional hook called with every song this parser is valid for before a batch is converted,
+        so parsers backed by an api can resolve them in bulk instead of one request per file
+        '''
+        pass
+
 class FileMetadata(MetadataParser):
     '''
     Reference implementation for a metadata parser
@@ -33,29 +86,23 @@ class FileMetadata(MetadataParser):
         return True
     
     def fetch(self, song: songclass.Song) -> None | songclass.Song:
-        meta = json.loads(subprocess.check_output(self.conf.metadata.file.ffprobe_command+(str(song.path),)).decode('utf8'))
-        output = {}
-        if 'tags' in meta['format']:
-            output.update(meta['format']['tags'])
-            output.pop("compatible_brands", None)
-            output.pop("encoder", None)
-            output.pop("ENCODER", None)
-            output.pop("encoded_by", None)
-            output.pop("major_brand", None)
-            output.pop("minor_brand", None)
-            output.pop("minor_version", None)
-            song.update(output)
+        probe = None
+        if self.conf.metadata.file.probe_backend == 'mutagen':
+            with metrics.span("probe", backend="mutagen"):
+                probe = self.probe_mutagen(song.path)
+        if probe is None:
+            with metrics.span("probe", backend="ffprobe"):
+                probe = self.probe_ffprobe(song.path)
+        tags, img = probe
+        output = dict(tags)
+        for ignored in IGNORED_TAGS:
+            output.pop(ignored, None)
+        song.update(output)
         song.setdefault("title", song.path.stem)
         song.setdefault("artist", song.path.parent.name)
         song.setdefault("album", song.path.parent.name)
 
-        for stream in meta['streams']:
-            if stream['codec_name'] in self.conf.metadata.file.thumbnail_types:
-                cmd = self.conf.metadata.file.ffthumb_pre_command+(str(song.path),)+self.conf.metadata.file.ffthumb_post_command
-                data = subprocess.check_output(cmd)
-                img = Image.open(io.BytesIO(data))
-                break
-        else:
+        if img is None:
             coverfile = pathlib.Path(song.path.parent, "cover.png")
             if coverfile.is_file():
                 img = Image.open(coverfile)
@@ -65,4 +112,73 @@ class FileMetadata(MetadataParser):
                 img = Image.new('RGBA', (1000,1000), 'black')
         song.cover_image = img
         song.parser = "Shrinkify/file"
-        return song
\ No newline at end of file
+        return song
+
+    def probe_ffprobe(self, path: pathlib.Path) -> tuple[dict[str, typing.Any], Image.Image | None]:
+        meta = json.loads(subprocess.check_output(self.conf.metadata.file.ffprobe_command+(str(path),)).decode('utf8'))
+        tags = meta['format'].get('tags', {})
+        for stream in meta['streams']:
+            if stream['codec_name'] in self.conf.metadata.file.thumbnail_types:
+                cmd = self.conf.metadata.file.ffthumb_pre_command+(str(path),)+self.conf.metadata.file.ffthumb_post_command
+                data = subprocess.check_output(cmd)
+                return tags, Image.open(io.BytesIO(data))
+        return tags, None
+
+    def probe_mutagen(self, path: pathlib.Path) -> tuple[dict[str, typing.Any], Image.Image | None] | None:
+        '''
+        Reads tags and the embedded cover in-process with a single parse of the file.
+        Returns None for containers mutagen can't read (mkv/webm), so the caller can fall back to ffprobe.
+        Tag names are normalized to the ones ffprobe reports.
+        '''
+        try:
+            muta_file = mutagen.File(path)
+        except mutagen.MutagenError as e:
+            logging.debug(f"mutagen could not read {path}: {e}")
+            return None
+        if muta_file is None:
+            return None
+        tags: dict[str, list[str]] = {}
+        pictures: list[tuple[int, bytes]] = []
+        muta_tags = muta_file.tags
+        if isinstance(muta_tags, mutagen.id3.ID3):
+            for frame in muta_tags.values():
+                if isinstance(frame, mutagen.id3.APIC):
+                    pictures.append((frame.type, frame.data))
+                elif isinstance(frame, mutagen.id3.COMM):
+                    tags.setdefault('comment', []).extend(str(t) for t in frame.text)
+                elif isinstance(frame, mutagen.id3.TXXX):
+                    tags.setdefault(frame.desc.lower(), []).extend(str(t) for t in frame.text)
+                elif frame.FrameID in ID3_TAGS:
+                    tags.setdefault(ID3_TAGS[frame.FrameID], []).extend(str(t) for t in frame.text)
+        elif isinstance(muta_tags, mutagen.mp4.MP4Tags):
+            for key, values in muta_tags.items():
+                if key == 'covr':
+                    pictures.extend((3, bytes(v)) for v in values)
+                elif key in ('trkn', 'disk'):
+                    number, total = values[0]
+                    tags['track' if key == 'trkn' else 'disc'] = [f"{number}/{total}" if total else str(number)]
+                elif key in MP4_TAGS:
+                    tags[MP4_TAGS[key]] = [str(v) for v in values]
+        elif isinstance(muta_tags, mutagen._vorbis.VComment):
+            for key, value in muta_tags:
+                key = key.lower()
+                if key == 'metadata_block_picture':
+                    try:
+                        picture = mutagen.flac.Picture(base64.b64decode(value))
+                    except (ValueError, mutagen.flac.error):
+                        continue
+                    pictures.append((picture.type, picture.data))
+                else:
+                    tags.setdefault(VORBIS_TAGS.get(key, key), []).append(value)
+        if isinstance(muta_file, mutagen.flac.FLAC):
+            pictures.extend((p.type, p.data) for p in muta_file.pictures)
+
+        img = None
+        if pictures:
+            #prefer the front cover, otherwise whatever comes first
+            data = sorted(pictures, key=lambda p: p[0] != 3)[0][1]
+            try:
+                img = Image.open(io.BytesIO(data))
+            except OSError as e:
+                logging.warning(f"Unreadable embedded picture in {path}: {e}")
+        return {k: v[0] if len(v) == 1 else v for k, v in tags.items() if v}, img
@@ -1,6 +1,5 @@
 from datetime import datetime
 import io
-import pathlib
 import subprocess
 import json
 import re
@@ -18,7 +17,8 @@ class NicoNicoMetadata(MetadataParser):
         self.conf = conf
         self.cache = cache.create_simple("niconicoMetadata") if cache is not None else None
         if self.cache:
-            self.cache.load_generic_schema("video_id", "raw_data")
+            self.cache.load_payload_schema("video_id", "raw_data", legacy_format='json')
+        self.thumbnails = cache.thumbnail_store() if cache is not None else caching.ThumbnailStore(self.conf)
 
     def check_valid(self, song: songclass.Song) -> bool:
         for regex in self.conf.metadata.niconico.filename_regex:
@@ -35,26 +35,23 @@ class NicoNicoMetadata(MetadataParser):
     
     def get_owner_icon(self, link: str):
         try:
-            owner_id = re.search('/\d+/(\d+\.jpg)', link).group(1)
+            owner_id = re.search(r'/\d+/(\d+)\.jpg', link).group(1)
         except AttributeError: #blank profile/etc
             return requests.get(link).content
-        if tuple(pathlib.Path(self.conf.general.cache_dir).glob(f"nnd{owner_id}.*")):
-            return next(pathlib.Path(self.conf.general.cache_dir).glob(f"nnd{owner_id}.*")).read_bytes()
-        else:
+        data = self.thumbnails.get(f"nnd{owner_id}")
+        if data is None:
             data = requests.get(link).content
-            if pathlib.Path(self.conf.general.cache_dir).is_dir():
-                pathlib.Path(self.conf.general.cache_dir, f'nnd{owner_id}').with_suffix(".jpg").write_bytes(data)
-            return data
+            self.thumbnails.put(f"nnd{owner_id}", data)
+        return data
     
     def fetch(self, song: songclass.Song) -> None | songclass.Song:
         video_id = self.get_id(song.path.name)
         cmd = [e.format(VIDEO_ID=video_id) for e in self.conf.metadata.niconico.fetch_command]
-        if self.cache and self.cache.contains(video_id=video_id):
-            data = json.loads(self.cache.fetch_one(video_id=video_id)['raw_data'])
-        else:
+        data = self.cache.get(video_id=video_id) if self.cache else None
+        if data is None:
             data = json.loads(subprocess.check_output(cmd).decode('utf8'))
             if self.cache:
-                self.cache.insert({'video_id': video_id, 'raw_data': json.dumps(data)}, key='video_id')
+                self.cache.put(data, video_id=video_id)
         
         video_date = datetime.strptime(data['upload_date'], r'%Y%m%d')
         
@@ -1,17 +1,20 @@
 import io
-import pathlib
 import re
 import requests
-import base64
 import logging
+import threading
+import concurrent.futures
 from PIL import Image
 from dateutil import parser as dateparser
-import json
+import typing
 from . import caching
 from .. import config
 from .. import songclass
 from . import file
 
+VIDEO_PARTS = 'contentDetails,id,liveStreamingDetails,localizations,player,recordingDetails,snippet,statistics,status,topicDetails'
+MAX_IDS_PER_REQUEST = 50 #limit of the `id` parameter of the data api
+
 class VideoNotFoundException(Exception):
     pass
 
@@ -20,8 +23,17 @@ class YoutubeMetadata(file.MetadataParser):
     def __init__(self, conf: config.Config, cache: caching.CacheConnector | None = None) -> None:
         self.conf = conf
         self.cache = cache.create_simple("youtubeMetadata") if cache is not None else None
+        self.channel_cache = cache.create_simple("youtubeChannel") if cache is not None else None
         if self.cache:
-            self.cache.load_generic_schema("video_id", "raw_data")
+            self.cache.load_payload_schema("video_id", "raw_data", legacy_format='base64json')
+        if self.channel_cache:
+            self.channel_cache.load_payload_schema("channel_id", "raw_data")
+        self.thumbnails = cache.thumbnail_store() if cache is not None else caching.ThumbnailStore(self.conf)
+        #channel id -> download in progress, so concurrent workers fetch each icon once
+        self.icon_downloads: dict[str, concurrent.futures.Future] = {}
+        self.icon_lock = threading.Lock()
+        #images are fetched without the api key, over their own pooled session
+        self.http = requests.Session()
         self.session = requests.Session()
         if self.conf.metadata.youtube.api_key is None:
             logging.warning("Youtube API key not specified in config")
@@ -44,42 +56,107 @@ class YoutubeMetadata(file.MetadataParser):
         return False
     
     def get_video_info(self, video_id: str) -> dict:
-        if self.cache and self.cache.contains(video_id=video_id):
-            fetch = self.cache.fetch_one(video_id=video_id)
-            try:
-                data = json.loads(base64.b64decode(fetch['raw_data']))['items'][0]
-            except IndexError:
-                raise VideoNotFoundException()
-        else:
-            resp = self.session.get('https://www.googleapis.com/youtube/v3/videos', params={'part': 'contentDetails,id,liveStreamingDetails,localizations,player,recordingDetails,snippet,statistics,status,topicDetails', 'id': video_id})
-            raw = resp.content
+        resp_data = self.cache.get(video_id=video_id) if self.cache else None
+        if resp_data is None:
+            resp = self.session.get('https://www.googleapis.com/youtube/v3/videos', params={'part': VIDEO_PARTS, 'id': video_id})
+            resp_data = resp.json()
+            if self.cache and resp_data['items']:
+                self.cache.put(resp_data, video_id=video_id)
+        try:
+            data = resp_data['items'][0]
+        except IndexError:
+            raise VideoNotFoundException()
+        return data
+    
+    def prefetch(self, songs: list[songclass.Song]) -> None:
+        '''Fills the cache for every uncached video in `songs`, 50 ids per request instead of one request per file'''
+        if not self.cache or not self.cache.use_cache:
+            #without a readable cache fetch would look every video up again, doubling the quota used
+            return
+        video_ids = self.cache.missing('video_id', filter(None, (self.get_id(song.path.name) for song in songs)))
+        for i in range(0, len(video_ids), MAX_IDS_PER_REQUEST):
+            batch = video_ids[i:i+MAX_IDS_PER_REQUEST]
+            resp_data = self.session.get('https://www.googleapis.com/youtube/v3/videos', params={'part': VIDEO_PARTS, 'id': ','.join(batch), 'maxResults': MAX_IDS_PER_REQUEST}).json()
+            if 'items' not in resp_data:
+                logging.warning(f"Batched video lookup failed: {resp_data.get('error', {}).get('message', resp_data)}")
+                return
+            #stored in the same shape as a single video response so get_video_info reads it unchanged
+            for item in resp_data['items']:
+                self.cache.put({'items': [item]}, video_id=item['id'])
+            logging.debug(f"Prefetched {len(resp_data['items'])}/{len(batch)} videos")
+        if not self.channel_cache:
+            return
+        channel_ids = []
+        for song in songs:
+            video_id = self.get_id(song.path.name)
+            resp_data = self.cache.get(video_id=video_id) if video_id else None
+            if resp_data and resp_data['items']:
+                channel_ids.append(resp_data['items'][0]['snippet']['channelId'])
+        self.prefetch_channels(channel_ids)
+
+    def prefetch_channels(self, channel_ids: typing.Iterable[str]):
+        assert self.channel_cache is not None
+        channel_ids = self.channel_cache.missing('channel_id', channel_ids)
+        for i in range(0, len(channel_ids), MAX_IDS_PER_REQUEST):
+            batch = channel_ids[i:i+MAX_IDS_PER_REQUEST]
+            resp_data = self.session.get('https://www.googleapis.com/youtube/v3/channels', params={'part': 'snippet', 'id': ','.join(batch), 'maxResults': MAX_IDS_PER_REQUEST}).json()
+            if 'items' not in resp_data:
+                logging.warning(f"Batched channel lookup failed: {resp_data.get('error', {}).get('message', resp_data)}")
+                return
+            for item in resp_data['items']:
+                self.channel_cache.put(item, channel_id=item['id'])
+            logging.debug(f"Prefetched {len(resp_data['items'])}/{len(batch)} channels")
+
+    def get_channel_info(self, channel_id: str) -> dict:
+        data = self.channel_cache.get(channel_id=channel_id) if self.channel_cache else None
+        if data is None:
+            resp_data = self.session.get('https://www.googleapis.com/youtube/v3/channels', params={'part': 'snippet', 'id': channel_id}).json()
             try:
-                data = resp.json()['items'][0]
-            except IndexError:
-                raise VideoNotFoundException()
-            if self.cache:
-                self.cache.insert({'video_id': video_id, 'raw_data': base64.b64encode(raw).decode('utf8')}, key='video_id')
-                
+                data = resp_data['items'][0]
+            except (KeyError, IndexError):
+                raise RuntimeError(f"Could not look up channel {channel_id}: {resp_data.get('error', {}).get('message', 'not found')}")
+            if self.channel_cache:
+                self.channel_cache.put(data, channel_id=channel_id)
         return data
     
     def get_thumbnail(self, video_id: str):
-        if tuple(pathlib.Path(self.conf.general.cache_dir).glob(f"{video_id}.*")):
-            return next(pathlib.Path(self.conf.general.cache_dir).glob(f"{video_id}.*")).read_bytes()
-        else:
-            data = requests.get(f"https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg").content
-            if pathlib.Path(self.conf.general.cache_dir).is_dir():
-                pathlib.Path(self.conf.general.cache_dir, video_id).with_suffix(".jpg").write_bytes(data)
-            return data
+        data = self.thumbnails.get(video_id)
+        if data is None:
+            data = self.http.get(f"https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg").content
+            self.thumbnails.put(video_id, data)
+        return data
     
-    def get_channel_icon(self, channel_id: str):
-        if tuple(pathlib.Path(self.conf.general.cache_dir).glob(f"{channel_id}.*")):
-            return next(pathlib.Path(self.conf.general.cache_dir).glob(f"{channel_id}.*")).read_bytes()
+    def get_channel_icon(self, channel_id: str) -> bytes:
+        data = self.thumbnails.get(channel_id)
+        if data is not None:
+            return data
+        with self.icon_lock:
+            download = self.icon_downloads.get(channel_id)
+            if download is not None:
+                waiting = True
+            else:
+                #a download may have finished since the store was checked, its entry is only removed after it is stored
+                data = self.thumbnails.get(channel_id)
+                if data is not None:
+                    return data
+                waiting = False
+                download = self.icon_downloads[channel_id] = concurrent.futures.Future()
+        if waiting:
+            return download.result()
+        try:
+            thumbnails = self.get_channel_info(channel_id)['snippet']['thumbnails']
+            data = self.http.get(max(thumbnails.values(), key=lambda o: o['height']+o['width'])['url']).content
+            self.thumbnails.put(channel_id, data)
+        except Exception as e:
+            download.set_exception(e)
+            raise
         else:
-            icon_json = json.loads(self.session.get(f"https://www.googleapis.com/youtube/v3/channels", params={'part': 'snippet', 'id': channel_id}).content)
-            data = requests.get(max(icon_json['items'][0]['snippet']['thumbnails'].values(), key=lambda o: o['height']+o['width'])['url']).content
-            if pathlib.Path(self.conf.general.cache_dir).is_dir():
-                pathlib.Path(self.conf.general.cache_dir, channel_id).with_suffix(".jpg").write_bytes(data)
+            download.set_result(data)
             return data
+        finally:
+            #later lookups are served by the thumbnail store
+            with self.icon_lock:
+                del self.icon_downloads[channel_id]
     
     def fetch(self, song: songclass.Song) -> None | songclass.Song:
         video_id = self.get_id(song.path.name)
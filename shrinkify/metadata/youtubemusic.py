@@ -1,13 +1,10 @@
 import io
 import logging
-import pathlib
 #from . import MetadataHandler
 import re
 import time
 import ytmusicapi
-import json
 import requests
-import base64
 from PIL import Image
 from . import caching
 from .. import config
@@ -20,17 +17,22 @@ class YoutubeMusicMetadata(file.MetadataParser):
         self.conf = conf
         self.cache = cache
         self.ytm = ytmusicapi.YTMusic()
+        self.thumbnails = cache.thumbnail_store() if cache is not None else caching.ThumbnailStore(self.conf)
+        #deadsimple_identifier asks for the same artists and albums many times per file and across an artist's tracks
+        self.memo = caching.MemoCache("ytm", self.conf.metadata.youtubemusic.memo_size)
         if self.cache is not None:
             self.song_cache = self.cache.create_simple("ytmSongCache")
-            self.song_cache.load_generic_schema("video_id", "raw_data")
+            self.song_cache.load_payload_schema("video_id", "raw_data", legacy_format='base64json')
             self.artist_cache = self.cache.create_simple("ytmArtistCache")
-            self.artist_cache.load_generic_schema("channel_id", "raw_data")
+            self.artist_cache.load_payload_schema("channel_id", "raw_data", legacy_format='base64json')
             self.aa_cache = self.cache.create_simple("ytmArtistAlbumCache")
-            self.aa_cache.load_schema("""CREATE TABLE IF NOT EXISTS ytmArtistAlbumCache(channel_id STRING NOT NULL, mode STRING NOT NULL, raw_data STRING NOT NULL, PRIMARY KEY (channel_id, mode));""")
+            self.aa_cache.load_payload_schema(("channel_id", "mode"), "raw_data", legacy_format='base64json')
             self.album_cache = self.cache.create_simple("ytmAlbumCache")
-            self.album_cache.load_generic_schema("browse_id", "raw_data")
+            self.album_cache.load_payload_schema("browse_id", "raw_data", legacy_format='base64json')
             self.search_cache = self.cache.create_simple("ytmSearchCache")
-            self.search_cache.load_schema("""CREATE TABLE IF NOT EXISTS ytmSearchCache(query STRING NOT NULL, filter STRING NOT NULL, raw_data STRING NOT NULL, PRIMARY KEY (query, filter));""")
+            self.search_cache.load_payload_schema(("query", "filter"), "raw_data", legacy_format='base64json')
+            self.discography_cache = self.cache.create_simple("ytmDiscographyIndex")
+            self.discography_cache.load_payload_schema("channel_id", "raw_data")
     
     def check_valid(self, song: songclass.Song) -> bool:
         for regex in self.conf.metadata.youtubemusic.filename_regex:
@@ -79,12 +81,10 @@ class YoutubeMusicMetadata(file.MetadataParser):
         song['album'] = album['title']
         song['year'] = album['year']
     
-        if tuple(pathlib.Path(self.conf.general.cache_dir).glob(f"{video_id}.*")):
-            thumb_data = next(pathlib.Path(self.conf.general.cache_dir).glob(f"{video_id}.*")).read_bytes()
-        else:
+        thumb_data = self.thumbnails.get(video_id)
+        if thumb_data is None:
             thumb_data = requests.get(max(album['thumbnails'], key=lambda t: t['height'])['url']).content
-            if pathlib.Path(self.conf.general.cache_dir).is_dir():
-                pathlib.Path(self.conf.general.cache_dir, video_id).with_suffix(".jpg").write_bytes(thumb_data)
+            self.thumbnails.put(video_id, thumb_data)
         song.cover_image = Image.open(io.BytesIO(thumb_data))
         song.parser = "Shrinkify/ytm"
         return song
@@ -128,27 +128,9 @@ class YoutubeMusicMetadata(file.MetadataParser):
             return None
         
         true_album = None
-        if 'albums' in artist_info:
-            album_list: list = self.get_artist_albums(true_id, params=None, singles=False) if 'params' in artist_info['albums'] else artist_info['albums']['results'] #type:ignore
-            for album_resp in album_list:
-                album = self.get_album(album_resp['browseId'])
-                for track in album['tracks']:
-                    if track['videoId'] == video_id:
-                        true_album = album_resp['browseId'], track
-                        break
-                if true_album:
-                    break
-                
-        if not true_album and 'singles' in artist_info:
-            single_list: list = self.get_artist_albums(true_id, params=None, singles=True) if 'params' in artist_info['singles'] else artist_info['singles']['results'] #type:ignore
-            for single_resp in single_list:
-                single = self.get_album(single_resp['browseId'])
-                for track in single['tracks']:
-                    if track['videoId'] == video_id:
-                        true_album = single_resp['browseId'], track
-                        break
-                if true_album:
-                    break
+        discography = self.get_discography(true_id, artist_info)
+        if video_id in discography:
+            true_album = tuple(discography[video_id])
         
         if not true_album:
             search = self.get_search(f"{artist_info['name']} - {song_info['videoDetails']['title']}", "songs", limit=20)
@@ -167,43 +149,72 @@ class YoutubeMusicMetadata(file.MetadataParser):
         else:
             return true_album
     
+    def get_discography(self, channel_id: str, artist_info: dict) -> dict[str, list]:
+        return self.memo.memoized(('discography', channel_id), lambda: self._get_discography(channel_id, artist_info))
+
+    def _get_discography(self, channel_id: str, artist_info: dict) -> dict[str, list]:
+        '''
+        Index of videoId -> [browseId, track] over every album and then every single of an artist,
+        so each track of the artist resolves with a lookup instead of fetching and scanning its albums.
+        Expires with the artist caches (see general.cache_ttl) to pick up new releases.
+        '''
+        data = self.discography_cache.get(channel_id=channel_id) if self.cache else None
+        if data is None:
+            data = {}
+            for mode in ('albums', 'singles'):
+                if mode not in artist_info:
+                    continue
+                release_list: list = self.get_artist_albums(channel_id, params=None, singles=mode == 'singles') if 'params' in artist_info[mode] else artist_info[mode]['results'] #type:ignore
+                for release_resp in release_list:
+                    for track in self.get_album(release_resp['browseId'])['tracks']:
+                        if track.get('videoId'):
+                            data.setdefault(track['videoId'], [release_resp['browseId'], track])
+            if self.cache:
+                self.discography_cache.put(data, channel_id=channel_id)
+        return data
+
     def get_search(self, query: str, filter: str, limit=5):
-        if self.cache and self.search_cache.contains(query=query, filter=filter):
-            data = json.loads(base64.b64decode(self.search_cache.fetch_one(query=query, filter=filter)['raw_data']))
-        else:
+        return self.memo.memoized(('search', query, filter), lambda: self._get_search(query, filter, limit))
+
+    def _get_search(self, query: str, filter: str, limit=5):
+        data = self.search_cache.get(query=query, filter=filter) if self.cache else None
+        if data is None:
             data = self.ytm.search(query, filter, limit=limit)
             if self.cache:
-                jsonified = base64.b64encode(json.dumps(data).encode("utf8")).decode("utf8")
-                self.search_cache.insert({"query": query, "filter": filter, "raw_data": jsonified}, key=('query', 'filter'))
+                self.search_cache.put(data, query=query, filter=filter)
         return data
 
     def get_song(self, video_id: str):
-        if self.cache and self.song_cache.contains(video_id=video_id):
-            data = json.loads(base64.b64decode(self.song_cache.fetch_one(video_id=video_id)['raw_data']))
-        else:
+        return self.memo.memoized(('song', video_id), lambda: self._get_song(video_id))
+
+    def _get_song(self, video_id: str):
+        data = self.song_cache.get(video_id=video_id) if self.cache else None
+        if data is None:
             data = self.ytm.get_song(video_id)
             if self.cache:
-                jsonified = base64.b64encode(json.dumps(data).encode("utf8")).decode("utf8")
-                self.song_cache.insert({"video_id": video_id, "raw_data": jsonified}, key='video_id')
+                self.song_cache.put(data, video_id=video_id)
         return data
 
     def get_artist(self, channel_id: str) -> dict | None:
         if not isinstance(channel_id, str):
             return None
-        if self.cache and self.artist_cache.contains(channel_id=channel_id):
-            data = json.loads(base64.b64decode(self.artist_cache.fetch_one(channel_id=channel_id)['raw_data']))
-        else:
+        return self.memo.memoized(('artist', channel_id), lambda: self._get_artist(channel_id))
+
+    def _get_artist(self, channel_id: str) -> dict | None:
+        data = self.artist_cache.get(channel_id=channel_id) if self.cache else None
+        if data is None:
             data = self.ytm.get_artist(channelId=channel_id)
             if self.cache:
-                jsonified = base64.b64encode(json.dumps(data).encode("utf8")).decode("utf8")
-                self.artist_cache.insert({"channel_id": channel_id, "raw_data": jsonified}, key='channel_id')
+                self.artist_cache.put(data, channel_id=channel_id)
         return data
     
     def get_artist_albums(self, channel_id: str, params: str | None = None, singles: bool = False):
+        return self.memo.memoized(('artist_albums', channel_id, singles), lambda: self._get_artist_albums(channel_id, params, singles))
+
+    def _get_artist_albums(self, channel_id: str, params: str | None = None, singles: bool = False):
         mode = 'singles' if singles else 'albums'
-        if self.cache and self.aa_cache.contains(channel_id=channel_id, mode=mode):
-            data = json.loads(base64.b64decode(self.aa_cache.fetch_one(channel_id=channel_id, mode=mode)['raw_data']))
-        else:
+        data = self.aa_cache.get(channel_id=channel_id, mode=mode) if self.cache else None
+        if data is None:
             artistdata = self.ytm.get_artist(channel_id) #don't use cache for params as it will likely be invalid
             browse_id = artistdata[mode]['browseId']
             if 'params' in artistdata[mode]:
@@ -216,17 +227,16 @@ class YoutubeMusicMetadata(file.MetadataParser):
                 logging.critical("The dreaded KeyError: gridRenderer has occurred. Returning an empty list")
                 return []
             if self.cache:
-                jsonified = base64.b64encode(json.dumps(data).encode("utf8")).decode("utf8")
-                self.aa_cache.insert({"channel_id": channel_id, "mode": mode, "raw_data": jsonified}, key=('channel_id', 'mode'))
+                self.aa_cache.put(data, channel_id=channel_id, mode=mode)
         return data
 
     def get_album(self, browse_id: str):
-        if self.cache and self.album_cache.contains(browse_id=browse_id):
-            data = json.loads(base64.b64decode(self.album_cache.fetch_one(browse_id=browse_id)['raw_data']))
-        else:
+        return self.memo.memoized(('album', browse_id), lambda: self._get_album(browse_id))
+
+    def _get_album(self, browse_id: str):
+        data = self.album_cache.get(browse_id=browse_id) if self.cache else None
+        if data is None:
             data = self.ytm.get_album(browseId=browse_id)
             if self.cache:
-                jsonified = base64.b64encode(json.dumps(data).encode("utf8")).decode("utf8")
-                self.album_cache.insert({"browse_id": browse_id, "raw_data": jsonified}, key='browse_id')
+                self.album_cache.put(data, browse_id=browse_id)
         return data
-        
\ No newline at end of file
@@ -0,0 +1,120 @@
+import contextlib
+import datetime
+import json
+import math
+import os
+import pathlib
+import threading
+import time
+import typing
+from .utils import atomicfile
+
+Labels = tuple[tuple[str, str], ...]
+
+def percentile(values: list[float], q: float) -> float:
+    '''Nearest-rank percentile of already sorted values'''
+    if not values:
+        return math.nan
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels: typing.Iterable[tuple[str, str]]) -> str:
+    labels = list(labels)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels) + "}"
+
+class Recorder(object):
+    """
+    Thread-safe collection of stage durations and event counters for a run.
+    Stages are timed with `span`, which can be nested and labelled, e.g.
+
+        with metrics.span("handler", handler="File") as labels:
+            ...
+            labels['result'] = 'hit'
+    """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.durations: dict[tuple[str, Labels], list[float]] = {}
+            self.counters: dict[tuple[str, Labels], int] = {}
+
+    @contextlib.contextmanager
+    def span(self, stage: str, **labels: str) -> typing.Iterator[dict[str, str]]:
+        '''Times the body as `stage`, labels added to the yielded dict inside the body are recorded too'''
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def observe(self, stage: str, seconds: float, **labels: str):
+        key = (stage, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.durations.setdefault(key, []).append(seconds)
+
+    def count(self, name: str, value: int = 1, **labels: str):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self) -> dict[str, typing.Any]:
+        with self.lock:
+            durations = {key: sorted(values) for key, values in self.durations.items()}
+            counters = dict(self.counters)
+        now = time.time()
+        return {
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'finished': datetime.datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+            'seconds': round(now - self.started, 3),
+            'stages': [{
+                'stage': stage,
+                'labels': dict(labels),
+                'count': len(values),
+                'total': sum(values),
+                'mean': sum(values) / len(values),
+                'p50': percentile(values, .5),
+                'p95': percentile(values, .95),
+                'max': values[-1],
+            } for (stage, labels), values in sorted(durations.items())],
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(counters.items())],
+        }
+
+    def prometheus(self, prefix: str = "shrinkify") -> str:
+        '''The metrics in the Prometheus text exposition format, stage durations as summaries with p50 and p95'''
+        summary = self.summary()
+        lines = [
+            f"# HELP {prefix}_stage_seconds Time spent in each stage of a conversion run",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for stage in summary['stages']:
+            labels = [('stage', stage['stage'])] + list(stage['labels'].items())
+            for quantile, key in (('0.5', 'p50'), ('0.95', 'p95')):
+                lines.append(f"{prefix}_stage_seconds{format_labels(labels + [('quantile', quantile)])} {stage[key]:.6f}")
+            lines.append(f"{prefix}_stage_seconds_sum{format_labels(labels)} {stage['total']:.6f}")
+            lines.append(f"{prefix}_stage_seconds_count{format_labels(labels)} {stage['count']}")
+        for name in sorted({counter['name'] for counter in summary['counters']}):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.extend(f"{prefix}_{name}_total{format_labels(counter['labels'].items())} {counter['value']}" for counter in summary['counters'] if counter['name'] == name)
+        lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{prefix}_last_run_timestamp_seconds {time.time():.0f}")
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path: os.PathLike | str):
+        atomicfile.write_atomic(pathlib.Path(path).expanduser(), json.dumps(self.summary(), indent=2).encode('utf8'), mode=0o644)
+
+    def write_textfile(self, path: os.PathLike | str):
+        #node_exporter may read the file at any time and usually runs as another user
+        atomicfile.write_atomic(pathlib.Path(path).expanduser(), self.prometheus().encode('utf8'), mode=0o644)
+
+#process wide recorder, stages all over the codebase report to it
+recorder = Recorder()
+span = recorder.span
+observe = recorder.observe
+count = recorder.count
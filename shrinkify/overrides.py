@@ -4,6 +4,7 @@ import pathlib
 import typing
 import re
 import copy
+import threading
 from PIL import Image
 from . import songclass
 from . import config
@@ -61,11 +62,91 @@ class Executions(object):
         self._recursive_set(namespace, key, Image.open(pathlib.Path(*pathcomponents)))
         return namespace
 
+class CompiledDirective(object):
+    """An override with its condition and execute strings compiled once instead of on every use"""
+    def __init__(self, raw: dict, source: str) -> None:
+        self.directive: str = raw['directive']
+        self.condition = compile(raw['condition'], f"<{source}: condition>", 'eval')
+        self.execute = compile(raw['execute'], f"<{source}: execute>", 'exec')
+
+def compile_directives(raw: list[dict] | dict, source: str) -> dict[str, list[CompiledDirective]]:
+    '''Compiles a list of directives (or a single one) and indexes them by `directive`'''
+    indexed: dict[str, list[CompiledDirective]] = {}
+    for directive in (raw if isinstance(raw, list) else [raw]):
+        compiled = CompiledDirective(directive, source)
+        indexed.setdefault(compiled.directive, []).append(compiled)
+    return indexed
+
+T = typing.TypeVar('T')
+
+#path -> (mtime_ns, size, parsed contents), shared by every Overrides instance
+_override_files: dict[str, tuple[int, int, typing.Any]] = {}
+_override_lock = threading.Lock()
+
+def load_override_file(path: pathlib.Path, parse: typing.Callable[[str, str], T], default: T) -> T:
+    '''Returns `parse(text, path)` of an override file, parsing it again only when the file changes'''
+    try:
+        stat = path.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return default
+    with _override_lock:
+        cached = _override_files.get(str(path))
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+    parsed = parse(path.read_text(), str(path))
+    with _override_lock:
+        _override_files[str(path)] = (stat.st_mtime_ns, stat.st_size, parsed)
+    return parsed
+
+def load_directive_file(path: pathlib.Path) -> dict[str, list[CompiledDirective]]:
+    '''Compiled directives of an overrides.json'''
+    return load_override_file(path, lambda text, source: compile_directives(json.loads(text), source), {})
+
+#key, replacement values or None, (op, value) edits
+BasicRule = tuple[str, tuple[str, ...] | None, tuple[tuple[str, str], ...]]
+
+def parse_basic_overrides(text: str) -> tuple[BasicRule, ...]:
+    '''Parses the lines of a simple `overrides` file, see Overrides.basic_override'''
+    rules: list[BasicRule] = []
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        key, prevalue = line.split("=")
+        entries = [entry for entry in prevalue.split(',') if entry]
+        #a single edit anywhere makes the line an edit, mixing in replacements is an error like before
+        if any(entry[0] in '+-' for entry in entries):
+            if any(entry[0] not in '+-' for entry in entries):
+                raise RuntimeError("Undefined behavior in override. Please specify only add and remove OR replacements")
+            rules.append((key, None, tuple((entry[0], entry[1:]) for entry in entries)))
+        else:
+            rules.append((key, tuple(prevalue.split(',')), ()))
+    return tuple(rules)
+
+def load_basic_file(path: pathlib.Path) -> tuple[BasicRule, ...]:
+    '''Rules of a simple `overrides` file'''
+    return load_override_file(path, lambda text, source: parse_basic_overrides(text), ())
+
 class Overrides(object):
     def __init__(self, conf: config.Config) -> None:
         self.conf = conf
         self.checkers = Checkers()
         self.executions = Executions()
+        #directory -> rules of every `overrides` file above and in it, outermost first.
+        #directories without a file are remembered too, so the tree is only walked once per directory
+        self.directory_rules: dict[pathlib.Path, tuple[BasicRule, ...]] = {}
+
+    def clear_cache(self):
+        '''Forgets resolved directories so overrides files created or edited since are picked up'''
+        self.directory_rules.clear()
+
+    def rules_for(self, folder: pathlib.Path) -> tuple[BasicRule, ...]:
+        rules = self.directory_rules.get(folder)
+        if rules is None:
+            inherited = self.rules_for(folder.parent) if folder.parent != folder else ()
+            rules = inherited + load_basic_file(pathlib.Path(self.conf.general.root, folder, 'overrides'))
+            self.directory_rules[folder] = rules
+        return rules
 
     @staticmethod
     def _recursive_access(obj, path: str | list) -> typing.Any:
@@ -80,61 +161,41 @@ class Overrides(object):
             else:
                 return getattr(obj, path[0])
 
-    def find_directives(self, **kwargs):
-        main_overrides = pathlib.Path(self.conf.cfgdir, 'overrides.json')
-        if main_overrides.exists():
-            for override in json.loads(main_overrides.read_text()):
-                yield override
+    def find_directives(self, directive: str, **kwargs) -> typing.Iterator[CompiledDirective]:
+        yield from load_directive_file(pathlib.Path(self.conf.cfgdir, 'overrides.json')).get(directive, ())
 
-        if 'song' in kwargs and pathlib.Path(kwargs['song'].path, 'overrides.json').is_file():
-            yield json.loads(pathlib.Path(kwargs['song'].path, 'overrides.json').read_text())
+        if 'song' in kwargs:
+            yield from load_directive_file(pathlib.Path(kwargs['song'].path, 'overrides.json')).get(directive, ())
         
         if "custom_directives" in kwargs and kwargs['custom_directives'] != None:
-            for directive in kwargs['custom_directives']:
-                yield directive
+            yield from compile_directives(kwargs['custom_directives'], "custom directives").get(directive, ())
 
     def basic_override(self, song: songclass.Song) -> songclass.Song:
         #format: key=(+-)value,value
-        #check if folders above contain a simple override file
-        for folder in reversed(song.path.parents):
-            ovf = pathlib.Path(self.conf.general.root, folder, 'overrides')
-            if ovf.is_file():
-                for line in ovf.read_text().split("\n"):
-                    line = line.strip()
-                    key, prevalue = line.split("=")
-                    if isinstance(song[key], str): #convert key to list
-                        song[key] = [song[key]]
-                    #check syntax for undefined behavior
-                    for entry in prevalue.split(','):
-                        if len(entry) == 0:
-                            continue
-                        if '+' == entry[0] or '-' == entry[0]:
-                            for entry in prevalue.split(','):
-                                if len(entry) == 0:
-                                    continue
-                                if entry[0] == '+':
-                                    if entry[1:] not in song[key]: #prevent duplicates
-                                        song[key].append(entry[1:])
-                                elif entry[0] == '-':
-                                    try:
-                                        song[key].remove(entry[1:])
-                                    except ValueError:
-                                        pass
-                                else:
-                                    raise RuntimeError("Undefined behavior in override. Please specify only add and remove OR replacements")
-                            break
-                    else:
-                        song[key] = prevalue.split(',')
+        #folders above the song can contain a simple override file, applied outermost first
+        for key, replacement, edits in self.rules_for(song.path.parent):
+            if isinstance(song[key], str): #convert key to list
+                song[key] = [song[key]]
+            if replacement is not None:
+                song[key] = list(replacement)
+                continue
+            for op, value in edits:
+                if op == '+':
+                    if value not in song[key]: #prevent duplicates
+                        song[key].append(value)
+                else:
+                    try:
+                        song[key].remove(value)
+                    except ValueError:
+                        pass
         return song
 
     def override(self, directive: str, custom_directives: typing.Optional[list[dict]] = None, **kwargs) -> dict[str, typing.Any]:
         """Common kwargs arguments: path, song"""
         # ns = Namespace(copy.deepcopy(kwargs))
-        for override in self.find_directives(custom_directives=custom_directives, **kwargs):
-            if override['directive'] != directive:
-                continue
-            if eval(override['condition'], globals(), kwargs):
-                exec(override['execute'], globals(), kwargs)
+        for override in self.find_directives(directive, custom_directives=custom_directives, **kwargs):
+            if eval(override.condition, globals(), kwargs):
+                exec(override.execute, globals(), kwargs)
             #replace values in the condition and execution
             #for i, value in enumerate(override['condition']):
             #    if not isinstance(value, str):
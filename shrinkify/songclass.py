@@ -8,6 +8,7 @@ class Song(object):
         self.path = path #should be the original, unprocessed path
         self.output = output
         self.cover_image = cover_image
+        self.cover_art: typing.Any = None #encoded cover, set once the song is prepared for conversion
         self._parser: typing.Optional[str] = None
         self.metadata: dict[str, typing.Any] = kwargs
     
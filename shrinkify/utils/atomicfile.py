@@ -0,0 +1,22 @@
+import os
+import pathlib
+import tempfile
+
+def write_atomic(path: os.PathLike | str, data: bytes, mode: int | None = None):
+    '''
+    Writes `data` to a temp file next to `path` and renames it over `path`,
+    so a concurrent reader sees either the old file or the new one and never a partial write.
+    mkstemp files are only readable by their owner, `mode` changes that.
+    '''
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=path.parent, prefix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(temp, mode)
+        os.replace(temp, path)
+    except BaseException:
+        pathlib.Path(temp).unlink(missing_ok=True)
+        raise
@@ -0,0 +1,63 @@
+import hashlib
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import typing
+
+SAMPLE_SIZE = 64*1024 #bytes read from the start, middle and end of a file
+
+def sampled_digest(path: os.PathLike | str, size: int | None = None) -> str:
+    '''
+    Fast content digest of a file: its size plus a hash of three sampled blocks.
+    Reads at most 192KiB no matter how large the file is, which is enough to tell audio files apart
+    without decoding them or reading them in full.
+    '''
+    size = size if size is not None else os.stat(path).st_size
+    digest = hashlib.blake2b(str(size).encode('ascii'), digest_size=20)
+    with open(path, 'rb') as f:
+        if size <= SAMPLE_SIZE*3:
+            digest.update(f.read())
+        else:
+            for offset in (0, (size - SAMPLE_SIZE)//2, size - SAMPLE_SIZE):
+                f.seek(offset)
+                digest.update(f.read(SAMPLE_SIZE))
+    return f"{size:x}-{digest.hexdigest()}"
+
+class DigestIndex(object):
+    """
+    Remembers the digest of every file by path, size and mtime, so a file is only read again when it changes.
+    `index` is a cache table, without one digests are only remembered for the current run.
+    """
+    def __init__(self, index: typing.Any = None) -> None:
+        self.index = index
+        self.lock = threading.RLock()
+        self._entries: dict[str, tuple[int, int, str]] | None = None
+
+    @property
+    def entries(self) -> dict[str, tuple[int, int, str]]:
+        with self.lock:
+            if self._entries is None:
+                self._entries = {}
+                if self.index is not None:
+                    self.index.load_schema(f"""CREATE TABLE IF NOT EXISTS {self.index.table}(path STRING PRIMARY KEY NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, digest STRING NOT NULL);
+                        CREATE INDEX IF NOT EXISTS {self.index.table}Digest ON {self.index.table}(digest);""")
+                    self._entries.update((row['path'], (row['size'], row['mtime_ns'], row['digest'])) for row in self.index.fetch_multiple())
+            return self._entries
+
+    def digest(self, path: os.PathLike | str, stat: os.stat_result | None = None) -> str:
+        path = pathlib.Path(path).expanduser().absolute()
+        stat = stat if stat is not None else path.stat()
+        entry = self.entries.get(str(path))
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        digest = sampled_digest(path, stat.st_size)
+        with self.lock:
+            self.entries[str(path)] = (stat.st_size, stat.st_mtime_ns, digest)
+        if self.index is not None:
+            try:
+                self.index.insert({'path': str(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}, key='path')
+            except sqlite3.OperationalError as e: #locked by another process, the digest is still remembered for this run
+                logging.warning(f"Could not store the digest of {path}: {e}")
+        return digest
@@ -0,0 +1,308 @@
+import ctypes
+import ctypes.util
+import itertools
+import logging
+import os
+import select
+import struct
+import time
+import typing
+from . import scanner
+
+#from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")
+
+class InotifyWatcher(object):
+    """Reports which directories below a root changed, using inotify (linux only)"""
+    def __init__(self, root: str, exclude: typing.Collection[str] = ()) -> None:
+        self.exclude = frozenset(exclude)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1: {os.strerror(errno)}")
+        self.watches: dict[int, str] = {}
+        self.add_tree(root)
+
+    def add_tree(self, top: str):
+        for directory in itertools.chain([top], (e.path for e in scanner.scan(top, exclude=self.exclude, directories=True) if not e.is_symlink())):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if directory == top and not self.watches:
+                    raise OSError(errno, f"inotify_add_watch {directory}: {os.strerror(errno)}")
+                #usually the directory is already gone again, or the user watch limit is reached
+                logging.warning(f"Could not watch {directory}: {os.strerror(errno)}")
+                continue
+            #re-adding a moved directory returns its existing watch, which now has a new path
+            self.watches[wd] = directory
+
+    def wait(self, timeout: float | None = None) -> set[str]:
+        '''Blocks until something changes (or `timeout` passes) and returns the changed directories'''
+        changed: set[str] = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 64*1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = os.fsdecode(data[offset+EVENT_HEADER.size:offset+EVENT_HEADER.size+length].rstrip(b'\0'))
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    #events were dropped, everything has to be looked at again
+                    changed.update(self.watches.values())
+                    continue
+                directory = self.watches.get(wd)
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                if directory is None:
+                    continue
+                changed.add(directory)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and name not in self.exclude:
+                    self.add_tree(os.path.join(directory, name))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(object):
+    """
+    Reports which directories below a root changed by comparing directory mtimes, for systems without inotify.
+    Only directories are stat'ed, and the delay between checks backs off while nothing changes.
+    """
+    def __init__(self, root: str, exclude: typing.Collection[str] = (), min_delay: float = .5, max_delay: float = 10) -> None:
+        self.exclude = frozenset(exclude)
+        self.min_delay = min_delay
+        self.max_delay = max(min_delay, max_delay)
+        self.delay = min_delay
+        self.mtimes: dict[str, int] = {}
+        self.add_tree(root)
+
+    def add_tree(self, top: str):
+        for directory in itertools.chain([top], (e.path for e in scanner.scan(top, exclude=self.exclude, directories=True) if not e.is_symlink())):
+            try:
+                self.mtimes[directory] = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+
+    def wait(self, timeout: float | None = None) -> set[str]:
+        time.sleep(self.delay if timeout is None else min(self.delay, timeout))
+        changed: set[str] = set()
+        for directory, mtime in list(self.mtimes.items()):
+            try:
+                current = os.stat(directory).st_mtime_ns
+            except OSError:
+                del self.mtimes[directory]
+                changed.add(directory)
+                continue
+            if current != mtime:
+                self.mtimes[directory] = current
+                changed.add(directory)
+                try:
+                    with os.scandir(directory) as it:
+                        new_dirs = [e.path for e in it if e.is_dir(follow_symlinks=False) and e.name not in self.exclude and e.path not in self.mtimes]
+                except OSError:
+                    continue
+                for new_dir in new_dirs:
+                    self.add_tree(new_dir)
+        self.delay = self.min_delay if changed else min(self.delay*2, self.max_delay)
+        return changed
+
+    def close(self):
+        pass
+
+def open_watcher(root: str, exclude: typing.Collection[str] = (), poll_delay: float = .5) -> InotifyWatcher | PollingWatcher:
+    try:
+        return InotifyWatcher(root, exclude)
+    except (OSError, AttributeError) as e: #AttributeError: libc without inotify
+        logging.info(f"inotify is unavailable ({e}), polling for changes instead")
+        return PollingWatcher(root, exclude, poll_delay)
+
+class DirectoryTree(object):
+    """Snapshot of the matching files below a root, grouped by directory so it can be refreshed one directory at a time"""
+    def __init__(self, root: str, suffixes: typing.Collection[str], exclude: typing.Collection[str] = (), ignore_prefix: str = "shrinkify_temp") -> None:
+        self.suffixes = frozenset(suffixes)
+        self.exclude = frozenset(exclude)
+        self.ignore_prefix = ignore_prefix
+        self.files: dict[str, dict[str, int]] = {} #directory -> name -> size
+        self.subdirs: dict[str, set[str]] = {}
+        self.scan(root)
+
+    def all_files(self) -> typing.Iterator[tuple[str, int]]:
+        for directory, files in self.files.items():
+            for name, size in files.items():
+                yield os.path.join(directory, name), size
+
+    def list_directory(self, directory: str) -> tuple[dict[str, int], set[str]]:
+        files: dict[str, int] = {}
+        subdirs: set[str] = set()
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        if entry.name not in self.exclude and not entry.is_symlink():
+                            subdirs.add(entry.name)
+                    elif os.path.splitext(entry.name)[1] in self.suffixes and not entry.name.startswith(self.ignore_prefix):
+                        files[entry.name] = entry.stat().st_size
+                except OSError: #removed while listing
+                    continue
+        return files, subdirs
+
+    def scan(self, top: str) -> dict[str, int]:
+        '''Adds `top` and everything below it, returns the files that were found'''
+        found: dict[str, int] = {}
+        pending = [top]
+        while pending:
+            directory = pending.pop()
+            try:
+                files, subdirs = self.list_directory(directory)
+            except OSError:
+                continue
+            self.files[directory] = files
+            self.subdirs[directory] = subdirs
+            found.update((os.path.join(directory, name), size) for name, size in files.items())
+            pending.extend(os.path.join(directory, name) for name in subdirs)
+        return found
+
+    def forget(self, top: str) -> dict[str, int]:
+        '''Drops `top` and everything below it, returns the files it contained'''
+        gone: dict[str, int] = {}
+        pending = [top]
+        while pending:
+            directory = pending.pop()
+            gone.update((os.path.join(directory, name), size) for name, size in self.files.pop(directory, {}).items())
+            pending.extend(os.path.join(directory, name) for name in self.subdirs.pop(directory, ()))
+        return gone
+
+    def refresh(self, directory: str) -> tuple[dict[str, int], dict[str, int]]:
+        '''
+        Re-reads a single directory, descending only into subdirectories that are new.
+        Returns (removed, added) files, files whose size changed count as added.
+        '''
+        if directory not in self.files:
+            return {}, self.scan(directory)
+        try:
+            files, subdirs = self.list_directory(directory)
+        except OSError:
+            return self.forget(directory), {}
+        old_files, old_subdirs = self.files[directory], self.subdirs[directory]
+        removed = {os.path.join(directory, name): size for name, size in old_files.items() if name not in files}
+        added = {os.path.join(directory, name): size for name, size in files.items() if old_files.get(name) != size}
+        for name in old_subdirs - subdirs:
+            removed.update(self.forget(os.path.join(directory, name)))
+        for name in subdirs - old_subdirs:
+            added.update(self.scan(os.path.join(directory, name)))
+        self.files[directory], self.subdirs[directory] = files, subdirs
+        return removed, added
+
+class MoveDetector(object):
+    """
+    Pairs files that disappeared with files that appeared. Sizes that are unique are enough to tell files apart,
+    files sharing a size are compared by sampled content digest, taken while they still exist.
+    Both halves of a move are remembered for `window` seconds, as they can show up in separate batches
+    (moves between directories or filesystems).
+    """
+    def __init__(self, files: typing.Iterable[tuple[str, int]], digest: typing.Callable[[str], str], window: float) -> None:
+        self.digest = digest
+        self.window = window
+        self.sizes: dict[str, int] = {}
+        self.by_size: dict[int, set[str]] = {}
+        self.digests: dict[str, str] = {}
+        self.missing: dict[str, tuple[int, str | None, float]] = {}
+        self.appeared: dict[str, float] = {}
+        for path, size in files:
+            self.add(path, size)
+
+    @property
+    def pending(self) -> bool:
+        return bool(self.missing or self.appeared)
+
+    def take_digest(self, path: str) -> str | None:
+        try:
+            self.digests[path] = self.digest(path)
+        except OSError:
+            return None
+        return self.digests[path]
+
+    def add(self, path: str, size: int):
+        self.discard(path)
+        self.sizes[path] = size
+        group = self.by_size.setdefault(size, set())
+        group.add(path)
+        if len(group) > 1:
+            #the content of a file can only be read while it exists, so shared sizes are digested up front
+            for member in group:
+                if member not in self.digests:
+                    self.take_digest(member)
+
+    def discard(self, path: str) -> tuple[int | None, str | None]:
+        size = self.sizes.pop(path, None)
+        if size is not None:
+            self.by_size[size].discard(path)
+            if not self.by_size[size]:
+                del self.by_size[size]
+        return size, self.digests.pop(path, None)
+
+    def update(self, removed: dict[str, int], added: dict[str, int]) -> list[tuple[str, str]]:
+        '''Records a batch of changes and returns the (old, new) paths of every move that can be told apart'''
+        now = time.monotonic()
+        for path, size in removed.items():
+            _, digest = self.discard(path)
+            self.missing[path] = (size, digest, now + self.window)
+        for path, size in added.items():
+            self.add(path, size)
+            self.appeared[path] = now + self.window
+        moves = []
+        if self.missing:
+            #files still being copied when they were first seen have grown since
+            for path in list(self.appeared):
+                try:
+                    size = os.stat(path).st_size
+                except OSError:
+                    del self.appeared[path]
+                    continue
+                if size != self.sizes.get(path):
+                    self.add(path, size)
+        for path, (size, digest, _) in list(self.missing.items()):
+            candidates = [p for p in self.appeared if self.sizes.get(p) == size]
+            if not candidates:
+                continue
+            if digest is None:
+                if len(candidates) > 1:
+                    logging.warning(f"Cannot tell which of {', '.join(candidates)} {path} was moved to")
+                    continue
+                match = candidates[0]
+            else:
+                match = next((p for p in candidates if (self.digests.get(p) or self.take_digest(p)) == digest), None)
+                if match is None:
+                    continue
+            del self.missing[path]
+            del self.appeared[match]
+            moves.append((path, match))
+        for path, (_, _, deadline) in list(self.missing.items()):
+            if deadline < now:
+                logging.debug(f"No destination found for {path}, assuming it was deleted")
+                del self.missing[path]
+        for path, deadline in list(self.appeared.items()):
+            if deadline < now:
+                del self.appeared[path]
+        return moves
@@ -0,0 +1,89 @@
+import email.utils
+import logging
+import threading
+import time
+import urllib.parse
+import requests
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket allowing `rate` requests per second with bursts of up to `burst`.
+    Time spent doing other work refills the bucket, so a request only waits if it would exceed the rate.
+    """
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def defer(self, seconds: float):
+        '''Blocks everyone using the bucket for `seconds`, e.g. when the server asks us to back off'''
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+#buckets are shared per host so every session talking to a host draws from the same budget
+_buckets: dict[str, TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+def bucket_for(host: str, rate: float, burst: int = 1) -> TokenBucket:
+    with _buckets_lock:
+        if host not in _buckets:
+            _buckets[host] = TokenBucket(rate, burst)
+        return _buckets[host]
+
+def retry_after(resp: requests.Response, default: float) -> float:
+    '''Seconds to wait according to the Retry-After header, which is either a number of seconds or an http date'''
+    value = resp.headers.get('Retry-After')
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+class RateLimitedSession(requests.Session):
+    """
+    Session that keeps requests to the hosts in `limits` under their rate (requests per second)
+    and retries 429/503 responses after the delay the server asks for (exponential backoff otherwise)
+    """
+    def __init__(self, limits: dict[str, float] | None = None, max_retries: int = 3) -> None:
+        super().__init__()
+        self.limits = limits if limits is not None else {}
+        self.max_retries = max_retries
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response: #type:ignore
+        host = urllib.parse.urlsplit(url).hostname or ''
+        bucket = bucket_for(host, self.limits[host]) if host in self.limits else None
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            resp = super().request(method, url, *args, **kwargs)
+            if resp.status_code not in (429, 503) or attempt >= self.max_retries:
+                return resp
+            delay = retry_after(resp, 2.0 ** attempt)
+            logging.info(f"{host} answered {resp.status_code}, retrying in {delay:.1f}s")
+            if bucket is not None:
+                bucket.defer(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,69 @@
+import os
+import typing
+
+def scan(root: os.PathLike | str, suffixes: typing.Collection[str] | None = None, exclude: typing.Collection[str] = (), directories: bool = False) -> typing.Iterator[os.DirEntry]:
+    '''
+    Lazily walks `root` with os.scandir and yields the DirEntry of every file (or every directory if `directories` is set).
+    Directories named in `exclude` are pruned before they are descended into and files are filtered by suffix
+    from their name alone, so excluded trees cost nothing and no file is stat'ed unless the caller asks.
+    A DirEntry caches its stat result, so callers should use `entry.stat()` instead of stat'ing the path again.
+    Like Path.rglob, symlinked directories are not descended into.
+    '''
+    exclude = frozenset(exclude)
+    pending = [os.fspath(root)]
+    while pending:
+        try:
+            it = os.scandir(pending.pop())
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        subdirs = []
+        with it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir:
+                    if entry.name in exclude:
+                        continue
+                    if directories:
+                        yield entry
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                elif not directories and (suffixes is None or os.path.splitext(entry.name)[1] in suffixes):
+                    yield entry
+        #depth first, in directory order
+        pending.extend(reversed(subdirs))
+
+def scan_sorted(root: os.PathLike | str, suffixes: typing.Collection[str] | None = None, exclude: typing.Collection[str] = (), rename: typing.Callable[[str], str] | None = None) -> typing.Iterator[tuple[tuple[str, ...], os.DirEntry]]:
+    '''
+    Like `scan`, but yields (relative path parts, entry) ordered by the parts, holding one directory listing per level in memory.
+    `rename` maps file names before they are ordered and yielded, so trees that name files differently
+    (sources and their outputs) can still be merged in one pass.
+    '''
+    exclude = frozenset(exclude)
+    def walk(directory: str, prefix: tuple[str, ...]) -> typing.Iterator[tuple[tuple[str, ...], os.DirEntry]]:
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return
+        children: list[tuple[str, bool, os.DirEntry]] = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                if entry.name not in exclude and not entry.is_symlink():
+                    children.append((entry.name, True, entry))
+            elif suffixes is None or os.path.splitext(entry.name)[1] in suffixes:
+                children.append((rename(entry.name) if rename is not None else entry.name, False, entry))
+        #a file sorts before a directory of the same name, as (name,) < (name, child)
+        children.sort(key=lambda c: (c[0], c[1]))
+        for name, is_dir, entry in children:
+            if is_dir:
+                yield from walk(entry.path, prefix + (name,))
+            else:
+                yield prefix + (name,), entry
+    yield from walk(os.fspath(root), ())
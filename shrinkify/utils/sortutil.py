@@ -2,6 +2,7 @@ import logging
 import pathlib
 import curses
 from .. import config
+from . import scanner
 
 class SortTool(object):
     def __init__(self, conf: config.Config) -> None:
@@ -10,8 +11,8 @@ class SortTool(object):
         self.reset_lists()
 
     def reset_lists(self):
-        self.sortfiles = tuple(self.sort_dir.rglob("*.*"))
-        self.placement_dirs = tuple(e for e in pathlib.Path(self.conf.general.root).rglob("*/") if not set(self.conf.general.exclude_filter).intersection(e.parts))
+        self.sortfiles = tuple(pathlib.Path(e.path) for e in scanner.scan(self.sort_dir) if '.' in e.name)
+        self.placement_dirs = tuple(pathlib.Path(e.path) for e in scanner.scan(self.conf.general.root, exclude=self.conf.general.exclude_filter, directories=True))
     
     def filter_placement(self, filterstr: str):
         return tuple(e for e in self.placement_dirs if filterstr in str(e.relative_to(self.conf.general.root)))
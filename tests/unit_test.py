@@ -1,9 +1,23 @@
 #!/usr/bin/env python3
+import base64
+import json
 import os
+import sqlite3
+import subprocess
+import sys
 import unittest
 import pathlib
+import tempfile
+import time
+import unittest.mock
 import shrinkify
 import shrinkify.overrides
+from shrinkify import manifest
+from shrinkify.metadata import caching
+from shrinkify import metrics
+from shrinkify.utils import fswatch
+from shrinkify.utils import ratelimit
+from PIL import Image
 
 class MetadataTester(unittest.TestCase):
     def __init__(self, *args, **kwargs):
@@ -25,5 +39,291 @@ class MetadataTester(unittest.TestCase):
         self.assertNotEqual(orig, test_song.cover_image)
 
 
+    def test_parse_basic_overrides(self):
+        rules = shrinkify.overrides.parse_basic_overrides("artist=a,b\n\n  genre=+rock,-pop  \n")
+        self.assertEqual(rules, (('artist', ('a', 'b'), ()), ('genre', None, (('+', 'rock'), ('-', 'pop')))))
+        for mixed in ("artist=a,+b", "artist=+a,b"):
+            with self.assertRaises(RuntimeError):
+                shrinkify.overrides.parse_basic_overrides(mixed)
+
+
+class EncodeCommandTester(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cfg = shrinkify.config.generate_default()
+        self.cfg.cfgdir = self.tmp.name
+        self.cfg.general.cache_file = pathlib.Path(self.tmp.name, "cache.sqlite")
+        self.cfg.general.manifest_file = pathlib.Path(self.tmp.name, "manifest.sqlite")
+        self.cfg.general.cache_dir = pathlib.Path(self.tmp.name, "cache")
+        self.cfg.general.root = pathlib.Path(self.tmp.name)
+        self.song = shrinkify.songclass.Song(pathlib.Path(self.tmp.name, "in.mp3"), output=pathlib.Path(self.tmp.name, "out.ogg"),
+                                             title="a=b;c", artist=["x", "y"], year="2020")
+        self.song.cover_image = Image.new("RGBA", (10, 10), "red")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_ffmetadata_escaping(self):
+        doc = shrinkify.ffmetadata_document({"title": "a=b;c#d\\e\nf"}).decode('utf8')
+        self.assertEqual(doc, ";FFMETADATA1\ntitle=a\\=b\\;c\\#d\\\\e\\\nf\n")
+
+    def test_tagged_command_ogg(self):
+        shrink = shrinkify.Shrinkify(self.cfg)
+        cmd, stdin = shrink.build_tagged_command(self.song)
+        self.assertEqual(cmd[-1], str(self.song.output_resolved))
+        self.assertIn('ffmetadata', cmd)
+        self.assertIn(b"title=a\\=b\\;c\n", stdin)
+        self.assertIn(b"artist=x, y\n", stdin)
+        self.assertIn(b"metadata_block_picture=", stdin)
+
+    def test_tagged_command_m4a(self):
+        self.cfg.general.output_type = '.m4a'
+        shrink = shrinkify.Shrinkify(self.cfg)
+        cmd, stdin = shrink.build_tagged_command(self.song, update=True)
+        self.assertIn('date=2020', cmd)
+        self.assertIn('attached_pic', cmd)
+        self.assertEqual(cmd[-3:-1], ['-c:a', 'copy'])
+        self.assertTrue(stdin.startswith(b"\x89PNG"))
+
+class ManifestTester(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cfg = shrinkify.config.generate_default()
+        self.cfg.general.manifest_file = pathlib.Path(self.tmp.name, "manifest.sqlite")
+        self.source = pathlib.Path(self.tmp.name, "in.mp3")
+        self.source.write_bytes(b"source")
+        self.output = pathlib.Path(self.tmp.name, "out", "in.ogg")
+        self.output.parent.mkdir()
+        self.output.write_bytes(b"output")
+        self.manifest = manifest.ConversionManifest(self.cfg)
+        self.manifest.mark(self.source, self.output, 'done')
+
+    def tearDown(self):
+        self.manifest.db.close()
+        self.tmp.cleanup()
+
+    def test_current(self):
+        self.assertTrue(self.manifest.is_current(self.source, self.output))
+
+    def test_changed_source(self):
+        self.source.write_bytes(b"longer source")
+        self.assertFalse(self.manifest.is_current(self.source, self.output))
+        self.manifest.mark(self.source, self.output, 'done')
+        stat = self.source.stat()
+        os.utime(self.source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertFalse(self.manifest.is_current(self.source, self.output))
+
+    def test_changed_profile(self):
+        self.cfg.conversion.thumbnail_quality += 1
+        self.assertFalse(manifest.ConversionManifest(self.cfg).is_current(self.source, self.output))
+        self.cfg.conversion.tag_mode = 'ffmpeg'
+        profile = manifest.ConversionManifest.profile_hash(self.cfg)
+        self.cfg.conversion.mid_args = self.cfg.conversion.mid_args + ['-q:a', '3']
+        self.assertNotEqual(manifest.ConversionManifest.profile_hash(self.cfg), profile)
+
+    def test_changed_output(self):
+        other = pathlib.Path(self.tmp.name, "elsewhere", "in.ogg")
+        other.parent.mkdir()
+        other.write_bytes(b"output")
+        self.assertFalse(self.manifest.is_current(self.source, other))
+
+    def test_missing_output(self):
+        self.output.unlink()
+        self.assertFalse(self.manifest.is_current(self.source, self.output))
+
+class MoveTester(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_directory_tree_refresh(self):
+        a = self.write("A/1.ogg", b"1")
+        self.write("A/skip.txt", b"")
+        self.write("compressed/1.ogg", b"1")
+        tree = fswatch.DirectoryTree(self.root, ('.ogg',), ('compressed',))
+        self.assertEqual(dict(tree.all_files()), {a: 1})
+        b = self.write("A/sub/2.ogg", b"22")
+        self.write("A/1.ogg", b"111")
+        removed, added = tree.refresh(os.path.join(self.root, "A"))
+        self.assertEqual((removed, added), ({}, {a: 3, b: 2}))
+        os.rename(os.path.join(self.root, "A"), os.path.join(self.root, "B"))
+        self.assertEqual(tree.refresh(os.path.join(self.root, "A")), ({a: 3, b: 2}, {}))
+        removed, added = tree.refresh(self.root)
+        self.assertEqual(set(added), {os.path.join(self.root, "B", "1.ogg"), os.path.join(self.root, "B", "sub", "2.ogg")})
+
+    def test_same_size_moves(self):
+        a, b = self.write("a.ogg", b"a"*100), self.write("b.ogg", b"b"*100)
+        digests = {}
+        moves = fswatch.MoveDetector([(a, 100), (b, 100)], lambda p: digests.setdefault(p, open(p, 'rb').read(1)), 10)
+        new_a, new_b = os.path.join(self.root, "x.ogg"), os.path.join(self.root, "y.ogg")
+        os.rename(b, new_a) #swapped names, only the content tells them apart
+        os.rename(a, new_b)
+        self.assertEqual(sorted(moves.update({a: 100, b: 100}, {new_a: 100, new_b: 100})), [(a, new_b), (b, new_a)])
+        self.assertFalse(moves.pending)
+
+    def test_split_batches_and_expiry(self):
+        a = self.write("a.ogg", b"a"*10)
+        moves = fswatch.MoveDetector([(a, 10)], lambda p: p, 0.1)
+        new = os.path.join(self.root, "sub", "a.ogg")
+        os.makedirs(os.path.dirname(new))
+        os.rename(a, new)
+        self.assertEqual(moves.update({a: 10}, {}), [])
+        self.assertTrue(moves.pending)
+        self.assertEqual(moves.update({}, {new: 10}), [(a, new)])
+        #a removal that is never matched is given up on after the window
+        moves.update({new: 10}, {})
+        time.sleep(0.15)
+        moves.update({}, {})
+        self.assertFalse(moves.pending)
+
+class CacheTester(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cfg = shrinkify.config.generate_default()
+        self.cfg.general.cache_file = pathlib.Path(self.tmp.name, "cache.sqlite")
+        self.cfg.general.cache_dir = pathlib.Path(self.tmp.name, "cache")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_deferred_commit_delay(self):
+        self.cfg.general.cache_commit_delay = 0.2
+        self.cfg.general.cache_busy_timeout = 2000
+        first, second = caching.CacheConnector(self.cfg), caching.CacheConnector(self.cfg)
+        table = first.create_simple("test")
+        table.load_payload_schema("key", "data")
+        other = second.create_simple("test")
+        other.load_payload_schema("key", "data")
+        table.put({'a': 1}, key="a")
+        #blocks on the first connector's write transaction until its timed commit
+        other.put({'b': 2}, key="b")
+        second.flush()
+        self.assertEqual(table.get(key="b"), {'b': 2})
+        first.db.close()
+        second.db.close()
+
+    def legacy_table(self, schema: str, rows: list[tuple]):
+        db = sqlite3.connect(self.cfg.general.cache_file)
+        db.execute(schema)
+        for row in rows:
+            db.execute(f"INSERT INTO {schema.split()[2]} VALUES ({', '.join('?' for _ in row)})", row)
+        db.commit()
+        db.close()
+
+    def test_migrate_legacy_payloads(self):
+        b64 = lambda data: base64.b64encode(json.dumps(data).encode('utf8')).decode('ascii')
+        self.legacy_table("CREATE TABLE ytmSearchCache (query STRING NOT NULL, filter STRING NOT NULL, raw_data STRING NOT NULL, PRIMARY KEY (query, filter))",
+                          [("q", "songs", b64([1, 2])), ("q", "videos", b64({'v': 1})), ("bad", "songs", "not base64 json")])
+        self.legacy_table("CREATE TABLE niconicoMetadata (video_id STRING PRIMARY KEY NOT NULL, raw_data STRING NOT NULL)",
+                          [("sm1", json.dumps({'title': 'a'})), ("sm2", "{")])
+        cache = caching.CacheConnector(self.cfg)
+        search = cache.create_simple("ytmSearchCache")
+        search.load_payload_schema(("query", "filter"), "raw_data", legacy_format='base64json')
+        nico = cache.create_simple("niconicoMetadata")
+        nico.load_payload_schema("video_id", "raw_data", legacy_format='json')
+        self.assertEqual(search.get(query="q", filter="songs"), [1, 2])
+        self.assertEqual(search.get(query="q", filter="videos"), {'v': 1})
+        self.assertEqual(nico.get(video_id="sm1"), {'title': 'a'})
+        #unreadable rows are dropped
+        self.assertEqual(len(search.fetch_multiple()), 2)
+        self.assertEqual(len(nico.fetch_multiple()), 1)
+        cache.db.close()
+
+    def test_migration_resumes(self):
+        self.legacy_table("CREATE TABLE youtubeMetadata (video_id STRING PRIMARY KEY NOT NULL, raw_data STRING NOT NULL)",
+                          [(f"v{i}", base64.b64encode(json.dumps(i).encode('utf8')).decode('ascii')) for i in range(10)])
+        encode = caching.encode_payload
+        encoded = []
+        def interrupt(data):
+            if len(encoded) == 5:
+                raise KeyboardInterrupt
+            encoded.append(data)
+            return encode(data)
+        with unittest.mock.patch.object(caching, 'MIGRATION_CHUNK', 2), unittest.mock.patch.object(caching, 'encode_payload', interrupt):
+            cache = caching.CacheConnector(self.cfg)
+            with self.assertRaises(KeyboardInterrupt):
+                cache.create_simple("youtubeMetadata").load_payload_schema("video_id", "raw_data", legacy_format='base64json')
+            cache.db.close()
+        db = sqlite3.connect(self.cfg.general.cache_file)
+        self.assertEqual(db.execute("SELECT format FROM shrinkifyCacheFormat WHERE table_name = 'youtubeMetadata'").fetchone(), ('base64json@4',))
+        db.close()
+        cache = caching.CacheConnector(self.cfg)
+        table = cache.create_simple("youtubeMetadata")
+        table.load_payload_schema("video_id", "raw_data", legacy_format='base64json')
+        #rows converted before the interruption are not decoded as base64 again (which would drop them)
+        self.assertEqual([table.get(video_id=f"v{i}") for i in range(10)], list(range(10)))
+        cache.db.close()
+
+class OrphanTester(unittest.TestCase):
+    def test_sorted_merge_matches_set_difference(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = shrinkify.config.generate_default()
+            cfg.cfgdir = tmp
+            cfg.general.cache_file = pathlib.Path(tmp, "cache.sqlite")
+            cfg.general.manifest_file = pathlib.Path(tmp, "manifest.sqlite")
+            cfg.general.root = pathlib.Path(tmp, "lib")
+            cfg.general.output = pathlib.Path(tmp, "out")
+            #names that sort differently once the extension is swapped for .ogg
+            sources = ["a.mp3", "a b.flac", "a-b.ogg", "a/x.mp3", "a.b/y.opus", "a0.m4a", "b/a.mp3"]
+            outputs = ["a.ogg", "a b.ogg", "a-b.ogg", "a/x.ogg", "a.b/y.ogg", "a0.ogg", "b/a.ogg",
+                       "a c.ogg", "a!.ogg", "a/y.ogg", "a.b.ogg", "a-c.ogg", "b.ogg", "b/a/a.ogg", "c/a.ogg"]
+            for name in sources:
+                pathlib.Path(cfg.general.root, name).parent.mkdir(parents=True, exist_ok=True)
+                pathlib.Path(cfg.general.root, name).touch()
+            for name in outputs:
+                pathlib.Path(cfg.general.output, name).parent.mkdir(parents=True, exist_ok=True)
+                pathlib.Path(cfg.general.output, name).touch()
+            shrink = shrinkify.Shrinkify(cfg)
+            expected = set(pathlib.Path(cfg.general.output).rglob("*.ogg")).difference(
+                shrink.get_output_file(path) for path in pathlib.Path(cfg.general.root).rglob("*") if path.suffix in cfg.general.input_types)
+            self.assertEqual(set(pathlib.Path(e.path) for e in shrink.find_orphans()), expected)
+            self.assertEqual(len(expected), 8)
+
+class RateLimitTester(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = ratelimit.TokenBucket(20)
+        start = time.monotonic()
+        for _ in range(5):
+            bucket.acquire()
+        #the first token is available immediately, the other four at 20 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+        bucket.defer(0.1)
+        start = time.monotonic()
+        bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+class MetricsTester(unittest.TestCase):
+    def test_prometheus_summary(self):
+        recorder = metrics.Recorder()
+        for i in range(1, 21):
+            recorder.observe("ffmpeg", i / 10)
+        with recorder.span("handler", handler="File") as labels:
+            labels['result'] = 'hit'
+        recorder.count("cache_lookups", table="youtubeMetadata", result="miss")
+        text = recorder.prometheus()
+        self.assertIn('shrinkify_stage_seconds{stage="ffmpeg",quantile="0.5"} 1.000000', text)
+        self.assertIn('shrinkify_stage_seconds{stage="ffmpeg",quantile="0.95"} 1.900000', text)
+        self.assertIn('shrinkify_stage_seconds_count{stage="handler",handler="File",result="hit"} 1', text)
+        self.assertIn('shrinkify_cache_lookups_total{result="miss",table="youtubeMetadata"} 1', text)
+
+class ImportTester(unittest.TestCase):
+    def test_cli_import_is_light(self):
+        #the api clients take a few hundred ms to import and are only needed once a handler that uses them runs
+        heavy = ('requests', 'ytmusicapi', 'acoustid', 'dateutil')
+        out = subprocess.run([sys.executable, "-c", f"import sys, shrinkify.exec; print(' '.join(m for m in {heavy!r} if m in sys.modules))"],
+                             capture_output=True, text=True, check=True, cwd=pathlib.Path(__file__).parent.parent)
+        self.assertEqual(out.stdout.strip(), "")
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file